@@ -3,6 +3,7 @@ from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework_simplejwt.tokens import RefreshToken
+from asgiref.sync import async_to_sync
 from django.contrib.auth import get_user_model
 from django.conf import settings
 from django.db import transaction
@@ -13,6 +14,8 @@ from .serializers import (
     AccountSerializer, 
     AddBalanceSerializer
 )
+from trading.gateway import gateway
+from trading.portfolio import portfolio_cache
 import datetime
 from decimal import Decimal
 
@@ -123,6 +126,7 @@ def add_balance(request):
             user = request.user
             user.balance += amount
             user.save()
+        async_to_sync(gateway.portfolio_changed)(user.id, balance=user.balance)
         
         return Response({
             'message': 'Balance added successfully',
@@ -135,6 +139,10 @@ def add_balance(request):
 @permission_classes([IsAuthenticated])
 def get_account_details(request):
     user = request.user
-    account_data = AccountSerializer(user).data
+    # Users with a live session are usually in the portfolio cache of the
+    # process hosting the engine; anyone else, or any request served by
+    # another process, is read from the database as before.
+    portfolio = portfolio_cache.peek(user.id) if gateway.hosts_engine else None
+    account_data = AccountSerializer(portfolio or user).data
     
     return Response(account_data, status=status.HTTP_200_OK)
\ No newline at end of file
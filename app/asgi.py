@@ -8,8 +8,13 @@ django.setup()
 from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 from django.core.asgi import get_asgi_application
+from trading.gateway import gateway
 from . import routing
 
+# An embedded engine runs in this server, and the REST views it serves reach
+# it; see trading.gateway.
+gateway.host()
+
 django_asgi_app = get_asgi_application()
 
 application = ProtocolTypeRouter({
@@ -61,12 +61,69 @@ TEMPLATES = [
 WSGI_APPLICATION = 'app.wsgi.application'
 ASGI_APPLICATION = 'app.asgi.application'
 
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer'
-    },
+# With REDIS_URL set, several ASGI workers and the engine process (see
+# TRADING_ENGINE_MODE) share one channel layer.
+REDIS_URL = os.getenv('REDIS_URL', '')
+CHANNEL_LAYER_CAPACITY = int(os.getenv('CHANNEL_LAYER_CAPACITY', '1000'))
+
+if REDIS_URL:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                'hosts': [REDIS_URL],
+                'capacity': CHANNEL_LAYER_CAPACITY,
+            },
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+            'CONFIG': {
+                'capacity': CHANNEL_LAYER_CAPACITY,
+            },
+        },
+    }
+
+TRADING_SEQUENCER_BATCH_SIZE = int(os.getenv('TRADING_SEQUENCER_BATCH_SIZE', '256'))
+TRADING_SETTLEMENT_QUEUE_SIZE = int(os.getenv('TRADING_SETTLEMENT_QUEUE_SIZE', '10000'))
+TRADING_SETTLEMENT_BATCH_SIZE = int(os.getenv('TRADING_SETTLEMENT_BATCH_SIZE', '500'))
+TRADING_MAX_BATCH_ORDERS = int(os.getenv('TRADING_MAX_BATCH_ORDERS', '500'))
+TRADING_PORTFOLIO_IDLE_SECONDS = float(os.getenv('TRADING_PORTFOLIO_IDLE_SECONDS', '600'))
+TRADING_HISTORY_PAGE_SIZE = int(os.getenv('TRADING_HISTORY_PAGE_SIZE', '100'))
+TRADING_HISTORY_MAX_PAGE_SIZE = int(os.getenv('TRADING_HISTORY_MAX_PAGE_SIZE', '1000'))
+TRADING_TICK_SIZE = os.getenv('TRADING_TICK_SIZE', '0.01')
+TRADING_TICK_SIZES = {}
+TRADING_JOURNAL_DIR = os.getenv('TRADING_JOURNAL_DIR', str(BASE_DIR / 'engine_data'))
+TRADING_JOURNAL_FSYNC = os.getenv('TRADING_JOURNAL_FSYNC', 'False').lower() == 'true'
+TRADING_SNAPSHOT_INTERVAL = int(os.getenv('TRADING_SNAPSHOT_INTERVAL', '50000'))
+TRADING_ORDERBOOK_PUBLISH_INTERVAL_MS = int(os.getenv('TRADING_ORDERBOOK_PUBLISH_INTERVAL_MS', '50'))
+# Closed candles kept per symbol and interval (1s, 5s, 1m, 5m, 1h).
+TRADING_CANDLE_HISTORY = int(os.getenv('TRADING_CANDLE_HISTORY', '500'))
+TRADING_OUTBOUND_MAX_PENDING = int(os.getenv('TRADING_OUTBOUND_MAX_PENDING', '500'))
+TRADING_OUTBOUND_MAX_LAG_SECONDS = float(os.getenv('TRADING_OUTBOUND_MAX_LAG_SECONDS', '10'))
+# 'embedded' runs the engine inside the ASGI process; 'remote' forwards to
+# the process running `manage.py run_engine`.
+TRADING_ENGINE_MODE = os.getenv('TRADING_ENGINE_MODE', 'embedded')
+TRADING_ENGINE_TIMEOUT_SECONDS = float(os.getenv('TRADING_ENGINE_TIMEOUT_SECONDS', '10'))
+# Symbols are spread over this many engine processes by a stable hash;
+# TRADING_SHARD_ASSIGNMENTS pins symbols to shards, e.g. "RELIANCE=0,TCS=1".
+TRADING_ENGINE_SHARDS = int(os.getenv('TRADING_ENGINE_SHARDS', '1'))
+TRADING_SHARD_ASSIGNMENTS = {
+    symbol.strip().upper(): int(shard)
+    for symbol, shard in (
+        assignment.split('=', 1) for assignment in os.getenv('TRADING_SHARD_ASSIGNMENTS', '').split(',') if '=' in assignment
+    )
 }
 
+# Take order reservations in the engine's in-memory ledger rather than with a
+# locking database write per order. Users' funds span every symbol, so this
+# needs a single engine owning all of them and is off when sharded.
+TRADING_RESERVATION_LEDGER = (
+    os.getenv('TRADING_RESERVATION_LEDGER', 'True').lower() == 'true' and TRADING_ENGINE_SHARDS == 1
+)
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
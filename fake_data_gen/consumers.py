@@ -1,11 +1,14 @@
+import asyncio
 import json
 import logging
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
 from fake_data_gen.fake_data_manager import fake_data_manager
 from accounts.authentication import JWTCookieAuthentication
 from channels.db import database_sync_to_async
 from django.contrib.auth import get_user_model
 from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from trading.outbound import OutboundQueue
 
 User = get_user_model()
 logger = logging.getLogger(__name__)
@@ -21,9 +24,16 @@ class FakeDataConsumer(AsyncWebsocketConsumer):
 
             self.scope['user'] = user
             await self.accept()
+
+            self.outbound = OutboundQueue(
+                self.send_frame,
+                self.drop_slow_connection,
+                max_pending=settings.TRADING_OUTBOUND_MAX_PENDING,
+                max_lag_seconds=settings.TRADING_OUTBOUND_MAX_LAG_SECONDS
+            )
+            self.outbound.start()
             
-            await fake_data_manager.send_initial_data(self.channel_name)
-            fake_data_manager.connected_consumers.add(self.channel_name)
+            fake_data_manager.add_consumer(self.channel_name, self.outbound)
 
             if not fake_data_manager.is_running:
                 await fake_data_manager.start()
@@ -43,37 +53,22 @@ class FakeDataConsumer(AsyncWebsocketConsumer):
     async def disconnect(self, close_code):
         try:
             if hasattr(self, 'channel_name'):
-                fake_data_manager.connected_consumers.discard(self.channel_name)
+                fake_data_manager.remove_consumer(self.channel_name)
+            if hasattr(self, 'outbound'):
+                self.outbound.close()
 
-            if not fake_data_manager.connected_consumers:
+            if not fake_data_manager.has_consumers():
                 await fake_data_manager.stop()
 
         except Exception as e:
             logger.error(f"Error in WebSocket disconnect: {e}")
 
-    async def initial_data(self, event):
-        try:
-            await self.send(text_data=event["message"])
-        except Exception as e:
-            logger.error(f"Error sending initial data: {e}")
-
-    async def market_data(self, event):
-        try:
-            await self.send(text_data=event["message"])
-        except Exception as e:
-            logger.error(f"Error sending market data: {e}")
+    async def send_frame(self, frame):
+        await self.send(text_data=frame)
 
-    async def orderbook_data(self, event):
-        try:
-            await self.send(text_data=event["message"])
-        except Exception as e:
-            logger.error(f"Error sending orderbook data: {e}")
-
-    async def trade_data(self, event):
-        try:
-            await self.send(text_data=event["message"])
-        except Exception as e:
-            logger.error(f"Error sending trade data: {e}")
+    def drop_slow_connection(self):
+        fake_data_manager.remove_consumer(self.channel_name)
+        asyncio.create_task(self.close(code=4008))
 
     @database_sync_to_async
     def get_user_from_cookie(self):
@@ -2,11 +2,17 @@ import asyncio
 import json
 import logging
 import random
+from collections import deque
 from datetime import datetime, timedelta
-from channels.layers import get_channel_layer
+from trading.fanout import FanoutHub
+from trading.outbound import OutboundQueue
 
 logger = logging.getLogger(__name__)
 
+# Ticks kept for the chart history every new connection starts from.
+HISTORY_SIZE = 250
+FEED_TOPIC = 'RELIANCE'
+
 class FakeDataManager:
     _instance = None
     
@@ -14,8 +20,16 @@ class FakeDataManager:
         if cls._instance is None:
             cls._instance = super(FakeDataManager, cls).__new__(cls)
             cls._instance.is_running = False
-            cls._instance.connected_consumers = set()
+            # Every tick is encoded once, as one `market_tick` frame and one
+            # `trade` frame, and put on each connection's outbound queue by
+            # the hub.
+            cls._instance.hub = FanoutHub()
             cls._instance._data_task = None
+            # Rolling tick history shared by all connections: seeded once,
+            # then extended by the live generator. The encoded
+            # `market_data_start` frame is cached until the next tick.
+            cls._instance.history = deque(maxlen=HISTORY_SIZE)
+            cls._instance._initial_frame = None
             cls._instance.initial_open = 2795.25
             cls._instance.previous_close = 2795.25
             cls._instance.reliance_data = {
@@ -49,8 +63,6 @@ class FakeDataManager:
                 await self._data_task
             except asyncio.CancelledError:
                 pass
-            
-        self.connected_consumers.clear()
 
     def _get_random_change(self, current_value, max_percent=2.0):
         if random.random() < 0.8:
@@ -143,30 +155,25 @@ class FakeDataManager:
         
         return historical_data
 
-    async def send_initial_data(self, channel_name):
-        try:
-            channel_layer = get_channel_layer()
-            historical_data = self.generate_historical_data()
-            
-            initial_message = {
+    def initial_frame(self) -> str:
+        if self._initial_frame is None:
+            self._seed_history()
+            self._initial_frame = json.dumps({
                 'type': 'market_data_start',
-                'data': historical_data
-            }
-            
-            await channel_layer.send(
-                channel_name,
-                {
-                    "type": "initial.data",
-                    "message": json.dumps(initial_message)
-                }
-            )
-            
-        except Exception as e:
-            logger.error(f"Error sending initial data to {channel_name}: {e}")
+                'data': list(self.history)
+            })
+        return self._initial_frame
+
+    def _seed_history(self):
+        if not self.history:
+            self.history.extend(self.generate_historical_data(count=HISTORY_SIZE))
+
+    def _append_history(self, data_point):
+        self._seed_history()
+        self.history.append(data_point)
+        self._initial_frame = None
 
     async def _generate_dummy_data(self):
-        channel_layer = get_channel_layer()
-        
         while self.is_running:
             try:
                 old_price = self.reliance_data['ltp']
@@ -184,56 +191,33 @@ class FakeDataManager:
                     self.reliance_data['change_percent'] = round((self.reliance_data['change'] / self.initial_open) * 100, 2)
 
                 market_data = {
-                    'type': 'market_data',
-                    'data': {
-                        'symbol': self.reliance_data['symbol'],
-                        'ltp': self.reliance_data['ltp'],
-                        'open': self.reliance_data['open'],
-                        'high': self.reliance_data['ltp'], 
-                        'low': self.reliance_data['ltp'], 
-                        'volume': tick_volume,            
-                        'change': self.reliance_data['change'],
-                        'change_percent': self.reliance_data['change_percent'],
-                        'timestamp': datetime.now().isoformat()+'Z'
-                    }
+                    'symbol': self.reliance_data['symbol'],
+                    'ltp': self.reliance_data['ltp'],
+                    'open': self.reliance_data['open'],
+                    'high': self.reliance_data['ltp'], 
+                    'low': self.reliance_data['ltp'], 
+                    'volume': tick_volume,            
+                    'change': self.reliance_data['change'],
+                    'change_percent': self.reliance_data['change_percent'],
+                    'timestamp': datetime.now().isoformat()+'Z'
                 }
                 
-                orderbook_data = self._generate_orderbook_data()
-                trade_data = self._generate_trade_data()
-                
-                if self.connected_consumers:
-                    for consumer_channel_name in list(self.connected_consumers):
-                        try:
-                            await channel_layer.send(
-                                consumer_channel_name,
-                                {
-                                    "type": "market.data", 
-                                    "message": json.dumps(market_data)
-                                }
-                            )
-                            
-                            await channel_layer.send(
-                                consumer_channel_name,
-                                {
-                                    "type": "orderbook.data", 
-                                    "message": json.dumps(orderbook_data)
-                                }
-                            )
-                            
-                            await channel_layer.send(
-                                consumer_channel_name,
-                                {
-                                    "type": "trade.data", 
-                                    "message": json.dumps(trade_data)
-                                }
-                            )
-                                
-                        except Exception as e:
-                            self.connected_consumers.discard(consumer_channel_name)
+                self._append_history(market_data)
+                # Ticks are conflated per connection: a socket that is behind
+                # skips to the latest one. Trades are not, so none is lost.
+                self.hub.publish(FEED_TOPIC, json.dumps({
+                    'type': 'market_tick',
+                    'data': {
+                        'market_data': market_data,
+                        'orderbook': self._generate_orderbook_data()['data']
+                    }
+                }))
+                self.hub.publish(FEED_TOPIC, json.dumps(self._generate_trade_data()), conflate=False)
                 
                 await asyncio.sleep(random.uniform(0.3, 0.8))
                 
             except Exception as e:
+                logger.error(f"Error generating market data: {e}")
                 await asyncio.sleep(2)
 
     def _generate_orderbook_data(self):
@@ -288,10 +272,15 @@ class FakeDataManager:
             }
         }
 
-    def add_consumer(self, channel_name):
-        self.connected_consumers.add(channel_name)
+    def add_consumer(self, channel_name, outbound: OutboundQueue):
+        # History first, so the connection's live ticks continue from it.
+        outbound.put(self.initial_frame())
+        self.hub.subscribe(FEED_TOPIC, channel_name, outbound)
 
     def remove_consumer(self, channel_name):
-        self.connected_consumers.discard(channel_name)
+        self.hub.unsubscribe(FEED_TOPIC, channel_name)
+
+    def has_consumers(self) -> bool:
+        return self.hub.subscriber_count(FEED_TOPIC) > 0
 
 fake_data_manager = FakeDataManager()
\ No newline at end of file
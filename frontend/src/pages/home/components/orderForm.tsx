@@ -1,4 +1,4 @@
-import React, { useEffect, useState } from 'react';
+import React, { useEffect, useRef, useState } from 'react';
 import { useGetAccountDetailsQuery } from "@/redux/slices/api.slice.ts";
 import { useWebSocket } from "@/hooks/useWebSocket.ts";
 import { Holding, WebSocketURL } from "@/lib/types.ts";
@@ -24,8 +24,16 @@ export interface PlaceOrderMessage {
     };
 }
 
+export interface OrderBookSnapshotRequest {
+    type: 'orderbook_snapshot';
+    data: {
+        symbol: string;
+    };
+}
+
 enum IncomingMessageType {
     Connection = 'connection_ack',
+    OrderBookDelta = 'orderbook_delta',
     OrderAck = 'order_placed_ack',
     UserUpdate = 'user_update',
     PlaceOrderError = 'place_order_error',
@@ -67,12 +75,48 @@ export interface UserUpdateMessage {
 
 type OrderBookType = ChartOrderBookDataType;
 
+export interface OrderBookDeltaMessage {
+    type: IncomingMessageType.OrderBookDelta,
+    data: {
+        symbol: string;
+        prev_seq: number;
+        seq: number;
+        changes: {
+            side: 'bid' | 'ask';
+            price: number;
+            quantity: number;
+            orders: number;
+        }[];
+        timestamp: string;
+    };
+}
+
+const applyOrderBookDelta = (book: OrderBookType, delta: OrderBookDeltaMessage['data']): OrderBookType => {
+    let bids = book.data.bids;
+    let asks = book.data.asks;
+    delta.changes.forEach(({ side, price, quantity, orders }) => {
+        const levels = (side === 'bid' ? bids : asks).filter(level => level.price !== price);
+        if (quantity > 0) {
+            levels.push({ price, quantity, orders });
+        }
+        if (side === 'bid') {
+            bids = levels.sort((a, b) => b.price - a.price);
+        } else {
+            asks = levels.sort((a, b) => a.price - b.price);
+        }
+    });
+    return {
+        ...book,
+        data: { ...book.data, bids, asks, seq: delta.seq, timestamp: delta.timestamp }
+    };
+};
+
 export interface OrderFormProps {
     symbol?: string;
     setOrderBookDatum?: React.Dispatch<React.SetStateAction<OrderBookType | null>>;
 }
 
-type IncomingData = OrderPlacedAckMessage | UserUpdateMessage | OrderBookType | ErrorMessage | {
+type IncomingData = OrderPlacedAckMessage | UserUpdateMessage | OrderBookType | OrderBookDeltaMessage | ErrorMessage | {
     type: IncomingMessageType.OrderExecuted
 };
 
@@ -88,6 +132,7 @@ const OrderForm: React.FC<OrderFormProps> = ({
     });
     const [isPlacingOrder, setIsPlacingOrder] = useState(false);
     const [availableQuantity, setAvailableQuantity] = useState<number>(0);
+    const orderBookRef = useRef<OrderBookType | null>(null);
 
     const {
         data: accountDetails,
@@ -171,13 +216,28 @@ const OrderForm: React.FC<OrderFormProps> = ({
     const {
         connected,
         sendMessage: placeOrder,
-    } = useWebSocket<PlaceOrderMessage, IncomingData>(WebSocketURL.OrderFeed, {
+    } = useWebSocket<PlaceOrderMessage | OrderBookSnapshotRequest, IncomingData>(WebSocketURL.OrderFeed, {
         onMessage: (data) => {
             switch (data.type) {
                 case ChartDataFeedType.OrderBook:
+                    orderBookRef.current = data;
                     setOrderBookDatum?.(data);
                     break;
 
+                case IncomingMessageType.OrderBookDelta: {
+                    const book = orderBookRef.current;
+                    if (!book || book.data.symbol !== data.data.symbol || data.data.seq <= (book.data.seq ?? 0)) {
+                        break;
+                    }
+                    if (data.data.prev_seq !== book.data.seq) {
+                        placeOrder({ type: 'orderbook_snapshot', data: { symbol: data.data.symbol } });
+                        break;
+                    }
+                    orderBookRef.current = applyOrderBookDelta(book, data.data);
+                    setOrderBookDatum?.(orderBookRef.current);
+                    break;
+                }
+
                 case IncomingMessageType.OrderAck:
                     setIsPlacingOrder(false);
                     resetForm();
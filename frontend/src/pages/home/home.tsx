@@ -89,6 +89,12 @@ const Home = () => {
                 case ChartDataFeedType.OldMarketData:
                     setDataPoints(data.data);
                     break;
+                case ChartDataFeedType.MarketTick:
+                    updateDataPoints(data.data.market_data);
+                    if (isPageVisible && fakeOrderBook) {
+                        setOrderBookData({ type: ChartDataFeedType.OrderBook, data: data.data.orderbook });
+                    }
+                    break;
                 default:
                     return;
 
@@ -152,10 +158,12 @@ export enum ChartDataFeedType {
     Trade = 'trade',
     OrderBook = 'orderbook',
     MarketData = 'market_data',
-    OldMarketData = 'market_data_start'
+    OldMarketData = 'market_data_start',
+    MarketTick = 'market_tick'
 }
 
-type ChartDataFeedTypes = ChartTradeDataType | ChartOrderBookDataType | ChartMarketDataType | StartChartMarketDataType;
+type ChartDataFeedTypes = ChartTradeDataType | ChartOrderBookDataType | ChartMarketDataType | StartChartMarketDataType
+    | ChartMarketTickType;
 
 export interface ChartTradeDataType {
     type: ChartDataFeedType.Trade;
@@ -184,6 +192,7 @@ export interface ChartOrderBookDataType {
             orders: number;
         }[];
         timestamp: string;
+        seq?: number;
     };
 }
 
@@ -195,4 +204,12 @@ export interface ChartMarketDataType {
 export interface StartChartMarketDataType {
     type: ChartDataFeedType.OldMarketData;
     data: CandleData[];
-}
\ No newline at end of file
+}
+
+export interface ChartMarketTickType {
+    type: ChartDataFeedType.MarketTick;
+    data: {
+        market_data: CandleData;
+        orderbook: ChartOrderBookDataType['data'];
+    };
+}
@@ -4,7 +4,7 @@ import { Account, User } from '@/lib/types';
 export const authApi = createApi({
     reducerPath: 'authApi',
     baseQuery: fetchBaseQuery({
-        baseUrl: 'http://localhost:8000/api/',
+        baseUrl: 'http://localhost:8001/api/',
         credentials: "include",
     }),
     endpoints: (builder) => ({
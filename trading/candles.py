@@ -0,0 +1,128 @@
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+from .clock import format_ns
+from .ticks import ticks_to_float
+
+# Candle intervals in seconds, keyed by the label clients see.
+CANDLE_INTERVALS = {'1s': 1, '5s': 5, '1m': 60, '5m': 300, '1h': 3600}
+
+
+class Candle:
+    # Prices are ticks; `start` is the interval's opening time in ns.
+    __slots__ = ('start', 'open', 'high', 'low', 'close', 'volume', 'trades')
+
+    def __init__(self, start: int, price: int, quantity: int):
+        self.start = start
+        self.open = self.high = self.low = self.close = price
+        self.volume = quantity
+        self.trades = 1
+
+    def add(self, price: int, quantity: int):
+        if price > self.high:
+            self.high = price
+        elif price < self.low:
+            self.low = price
+        self.close = price
+        self.volume += quantity
+        self.trades += 1
+
+
+class CandleSeries:
+    # One interval of one symbol: the open candle, the last `history` closed
+    # ones, and what changed since the last take_changes().
+    __slots__ = ('interval_ns', 'current', 'closed', 'changed')
+
+    def __init__(self, interval_ns: int, history: int):
+        self.interval_ns = interval_ns
+        self.current: Optional[Candle] = None
+        self.closed = deque(maxlen=history)
+        self.changed: List[Candle] = []
+
+    def add(self, price: int, quantity: int, timestamp: int):
+        start = timestamp - timestamp % self.interval_ns
+        current = self.current
+        if current is not None and start <= current.start:
+            # Trade timestamps only go forward, barring clock skew between
+            # engine processes; a late trade is folded into the open candle.
+            current.add(price, quantity)
+        else:
+            if current is not None:
+                self.closed.append(current)
+            self.current = current = Candle(start, price, quantity)
+        if not self.changed or self.changed[-1] is not current:
+            self.changed.append(current)
+            if len(self.changed) > self.closed.maxlen:
+                # Nobody has taken changes in a while; older ones are only in
+                # the history now.
+                del self.changed[0]
+
+    def candles(self) -> List[Candle]:
+        candles = list(self.closed)
+        if self.current is not None:
+            candles.append(self.current)
+        return candles
+
+
+class CandleAggregator:
+    # OHLCV candles built from executed trades, for every interval at once.
+    # Folding a trade touches only the open candle of each interval, and
+    # closed candles are kept in fixed-size ring buffers, so both the cost
+    # per trade and the memory per symbol are constant. Changes since the
+    # last take_changes() are tracked per interval, for publishing as deltas.
+    # Each symbol's version moves with every trade folded in, which is what
+    # invalidates its cached history message.
+    def __init__(self, intervals: Dict[str, int] = None, history: int = 500):
+        self.intervals = intervals or CANDLE_INTERVALS
+        self.history = history
+        self._series: Dict[str, Dict[str, CandleSeries]] = {}
+        self._versions: Dict[str, int] = {}
+        self._history_messages: Dict[str, Tuple[int, str]] = {}
+
+    def add_trade(self, symbol: str, price: int, quantity: int, timestamp: int):
+        series = self._series.get(symbol)
+        if series is None:
+            series = self._series[symbol] = {
+                label: CandleSeries(seconds * 1_000_000_000, self.history)
+                for label, seconds in self.intervals.items()
+            }
+        for candles in series.values():
+            candles.add(price, quantity, timestamp)
+        self._versions[symbol] = self._versions.get(symbol, 0) + 1
+
+    def version_of(self, symbol: str) -> int:
+        return self._versions.get(symbol, 0)
+
+    def take_changes(self, symbol: str) -> Optional[Dict[str, List[Dict]]]:
+        # The candles each interval opened or updated since the last call,
+        # oldest first; the last one of each is still open.
+        changes = {}
+        for label, series in self._series.get(symbol, {}).items():
+            if series.changed:
+                changes[label] = [self._encode(symbol, candle) for candle in series.changed]
+                series.changed = []
+        return changes or None
+
+    def history_of(self, symbol: str) -> Dict[str, List[Dict]]:
+        return {
+            label: [self._encode(symbol, candle) for candle in series.candles()]
+            for label, series in self._series.get(symbol, {}).items()
+        }
+
+    def cached_history(self, symbol: str, build) -> str:
+        version = self.version_of(symbol)
+        cached = self._history_messages.get(symbol)
+        if cached is None or cached[0] != version:
+            cached = self._history_messages[symbol] = (version, build(self.history_of(symbol)))
+        return cached[1]
+
+    def _encode(self, symbol: str, candle: Candle) -> Dict:
+        return {
+            'time': format_ns(candle.start),
+            'open': ticks_to_float(symbol, candle.open),
+            'high': ticks_to_float(symbol, candle.high),
+            'low': ticks_to_float(symbol, candle.low),
+            'close': ticks_to_float(symbol, candle.close),
+            'volume': candle.volume,
+            'trades': candle.trades
+        }
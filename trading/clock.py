@@ -0,0 +1,19 @@
+import time
+from datetime import datetime, timezone
+
+# Wall-clock nanoseconds read off the monotonic clock, so engine timestamps
+# never go backwards when the system clock is stepped.
+_OFFSET_NS = time.time_ns() - time.monotonic_ns()
+
+
+def now_ns() -> int:
+    return time.monotonic_ns() + _OFFSET_NS
+
+
+def to_datetime(ns: int) -> datetime:
+    seconds, remainder = divmod(ns, 1_000_000_000)
+    return datetime.fromtimestamp(seconds, tz=timezone.utc).replace(microsecond=remainder // 1000)
+
+
+def format_ns(ns: int) -> str:
+    return to_datetime(ns).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
\ No newline at end of file
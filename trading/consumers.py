@@ -1,3 +1,4 @@
+import asyncio
 import json
 import logging
 from channels.generic.websocket import AsyncWebsocketConsumer
@@ -5,8 +6,12 @@ from accounts.authentication import JWTCookieAuthentication
 from channels.db import database_sync_to_async
 from django.contrib.auth import get_user_model
 from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
-from .matching_engine import matching_engine
-from decimal import Decimal
+from .gateway import gateway
+from .matching_engine import normalize_symbol, user_group, DEFAULT_SYMBOL
+from .orders import place_order_batch, refund_orders
+from .outbound import OutboundQueue
+from .ticks import from_ticks, ticks_to_float, to_ticks
+from django.conf import settings
 from django.db import transaction
 
 User = get_user_model()
@@ -21,9 +26,15 @@ class TradingConsumer(AsyncWebsocketConsumer):
                 return
 
             self.scope['user'] = user
+            await self.channel_layer.group_add(user_group(user.id), self.channel_name)
             await self.accept()
 
-            matching_engine.add_trading_consumer(self.channel_name)
+            self.outbound = OutboundQueue(
+                self.send_frame,
+                self.drop_slow_connection,
+                max_pending=settings.TRADING_OUTBOUND_MAX_PENDING,
+                max_lag_seconds=settings.TRADING_OUTBOUND_MAX_LAG_SECONDS
+            )
 
             await self.send(text_data=json.dumps({
                 'type': 'connection_ack',
@@ -32,19 +43,28 @@ class TradingConsumer(AsyncWebsocketConsumer):
                     'user_id': user.id,
                     'user_email': user.email,
                     'balance': float(user.balance),
-                    'update_interval': '500ms'
+                    'update_interval': f'{settings.TRADING_ORDERBOOK_PUBLISH_INTERVAL_MS}ms'
                 }
             }))
 
+            await gateway.start()
+            await gateway.add_trading_consumer(self.channel_name)
+            await gateway.subscribe_orderbook(self.channel_name, DEFAULT_SYMBOL, self.outbound)
+            self.outbound.start()
+
         except Exception as e:
             await self.close(code=4000)
 
     async def disconnect(self, close_code):
         try:
             if hasattr(self, 'channel_name'):
-                matching_engine.remove_trading_consumer(self.channel_name)
+                await gateway.remove_trading_consumer(self.channel_name)
+            if hasattr(self, 'outbound'):
+                self.outbound.close()
             
             user = self.scope.get('user')
+            if user and user.is_authenticated:
+                await self.channel_layer.group_discard(user_group(user.id), self.channel_name)
             user_identifier = getattr(user, 'email', 'Unknown') if user and user.is_authenticated else 'Anonymous'
         except Exception as e:
             logger.error(f"Error: {e}", exc_info=True)
@@ -64,6 +84,18 @@ class TradingConsumer(AsyncWebsocketConsumer):
                 await self.send(text_data=json.dumps({'type': 'pong'}))
             elif message_type == 'place_order':
                 await self.handle_place_order(data.get('data', {}))
+            elif message_type == 'place_orders':
+                await self.handle_place_orders(data.get('data', {}))
+            elif message_type == 'cancel_order':
+                await self.handle_cancel_order(data.get('data', {}))
+            elif message_type == 'amend_order':
+                await self.handle_amend_order(data.get('data', {}))
+            elif message_type == 'orderbook_snapshot':
+                await self.handle_snapshot_request(data.get('data', {}))
+            elif message_type == 'subscribe':
+                await self.handle_subscription(data.get('data', {}), subscribe=True)
+            elif message_type == 'unsubscribe':
+                await self.handle_subscription(data.get('data', {}), subscribe=False)
             else:
                 await self.send_error(f"Unknown message type: {message_type}")
                 
@@ -81,47 +113,64 @@ class TradingConsumer(AsyncWebsocketConsumer):
                     await self.send_order_error(f'Missing required field: {field}')
                     return
             
-            price = Decimal(str(order_data['price']))
+            symbol = normalize_symbol(order_data.get('symbol'))
+            price = to_ticks(symbol, order_data['price'])
             quantity = int(order_data['quantity'])
             order_type = order_data['order_type'].upper()
 
-            if price <= Decimal('0') or quantity <= 0:
+            if price <= 0 or quantity <= 0:
                 await self.send_order_error("Price and quantity must be positive")
                 return
             if order_type not in ['BUY', 'SELL']:
                 await self.send_order_error("Order type must be BUY or SELL")
                 return
 
-            if order_type == 'BUY':
-                required_amount = price * Decimal(quantity)
-                success = await self.deduct_balance_for_buy_order(user.id, required_amount)
-                if not success:
+            # With the reservation ledger on, the engine reserves the order
+            # itself when it is added.
+            if settings.TRADING_RESERVATION_LEDGER:
+                pass
+            elif order_type == 'BUY':
+                required_amount = from_ticks(symbol, price * quantity)
+                balance = await self.deduct_balance_for_buy_order(user.id, required_amount)
+                if balance is None:
                     await self.send_order_error(f"Insufficient balance. Required: {required_amount}")
                     return
+                await gateway.portfolio_changed(user.id, balance=balance)
             else:
-                success = await self.deduct_holdings_for_sell_order(user.id, 'RELIANCE', quantity)
-                if not success:
+                holding = await self.deduct_holdings_for_sell_order(user.id, symbol, quantity)
+                if holding is None:
                     await self.send_order_error(f"Insufficient holdings for sell order")
                     return
+                await gateway.portfolio_changed(user.id, holdings={symbol: holding})
 
             order_request = {
                 'user_id': user.id,
                 'user_email': user.email,
-                'symbol': 'RELIANCE',
+                'symbol': symbol,
                 'order_type': order_type,
-                'price': float(price),
+                'price': price,
                 'quantity': quantity
             }
 
-            result = await matching_engine.add_order(order_request)
-            
+            try:
+                result = await gateway.add_order(order_request)
+            except Exception:
+                if not settings.TRADING_RESERVATION_LEDGER:
+                    balance, holdings = await database_sync_to_async(refund_orders)(user.id, [order_request])
+                    await gateway.portfolio_changed(user.id, balance=balance, holdings=holdings)
+                raise
+            if not result['success']:
+                await self.send_order_error(result['error'])
+                return
+
             await self.send(text_data=json.dumps({
                 'type': 'order_placed_ack',
                 'data': {
                     'order_id': result['order']['id'],
                     'message': 'Order placed successfully',
+                    'symbol': symbol,
                     'order_type': order_type,
-                    'price': float(price),
+                    'price': ticks_to_float(symbol, price),
                     'quantity': quantity,
                     'matches': len(result['matches'])
                 }
@@ -132,17 +181,159 @@ class TradingConsumer(AsyncWebsocketConsumer):
         except Exception as e:
             await self.send_order_error('Failed to place order')
 
-    async def orderbook_update(self, event):
+    async def handle_place_orders(self, batch_data):
+        user = self.scope['user']
         try:
-            await self.send(text_data=event["message"])
+            results = await place_order_batch(user, batch_data.get('orders'))
+            accepted = sum(1 for result in results if result['success'])
+
+            await self.send(text_data=json.dumps({
+                'type': 'orders_placed_ack',
+                'data': {
+                    'message': f'{accepted} of {len(results)} orders placed',
+                    'accepted': accepted,
+                    'rejected': len(results) - accepted,
+                    'results': results
+                }
+            }))
+
+        except (ValueError, TypeError, AttributeError) as e:
+            await self.send_order_error(f'Invalid order batch: {str(e)}')
         except Exception as e:
-            logger.error(f"Error sending orderbook update: {e}")
+            await self.send_order_error('Failed to place orders')
+
+    async def handle_cancel_order(self, cancel_data):
+        user = self.scope['user']
+        try:
+            if 'order_id' not in cancel_data:
+                await self.send_order_error('Missing required field: order_id')
+                return
+
+            symbol = normalize_symbol(cancel_data.get('symbol'))
+            result = await gateway.cancel_order(symbol, int(cancel_data['order_id']), user.id)
+            if not result['success']:
+                await self.send_order_error(result['error'])
+                return
+
+            order = result['order']
+            await self.send(text_data=json.dumps({
+                'type': 'order_cancelled_ack',
+                'data': {
+                    'order_id': order['id'],
+                    'message': 'Order cancelled successfully',
+                    'symbol': symbol,
+                    'cancelled_quantity': order['remaining_quantity']
+                }
+            }))
+
+        except (ValueError, TypeError) as e:
+            await self.send_order_error(f'Invalid cancel request: {str(e)}')
+        except Exception as e:
+            await self.send_order_error('Failed to cancel order')
+
+    async def handle_amend_order(self, amend_data):
+        user = self.scope['user']
+        try:
+            if 'order_id' not in amend_data:
+                await self.send_order_error('Missing required field: order_id')
+                return
+            if 'price' not in amend_data and 'quantity' not in amend_data:
+                await self.send_order_error('Nothing to amend: provide price and/or quantity')
+                return
+
+            symbol = normalize_symbol(amend_data.get('symbol'))
+            order_id = int(amend_data['order_id'])
+            price = to_ticks(symbol, amend_data['price']) if 'price' in amend_data else None
+            quantity = int(amend_data['quantity']) if 'quantity' in amend_data else None
+
+            if (price is not None and price <= 0) or (quantity is not None and quantity <= 0):
+                await self.send_order_error("Price and quantity must be positive")
+                return
+
+            order = await gateway.get_order(symbol, order_id)
+            if order is None or order['user_id'] != user.id:
+                await self.send_order_error('Order not found')
+                return
+
+            reserved_extra = 0
+            if order['order_type'] == 'BUY' and price is not None and not settings.TRADING_RESERVATION_LEDGER:
+                new_quantity = quantity if quantity is not None else order['remaining_quantity']
+                required_amount = price * new_quantity
+                reserved_amount = order['price'] * order['remaining_quantity']
+                if required_amount > reserved_amount:
+                    reserved_extra = required_amount - reserved_amount
+                    balance = await self.deduct_balance_for_buy_order(user.id, from_ticks(symbol, reserved_extra))
+                    if balance is None:
+                        await self.send_order_error(f"Insufficient balance. Required: {from_ticks(symbol, reserved_extra)}")
+                        return
+                    await gateway.portfolio_changed(user.id, balance=balance)
+
+            result = await gateway.amend_order(
+                symbol, order_id, user.id,
+                price=price,
+                quantity=quantity,
+                reserved_extra=reserved_extra
+            )
+            if not result['success']:
+                await self.send_order_error(result['error'])
+                return
+
+            order = result['order']
+            await self.send(text_data=json.dumps({
+                'type': 'order_amended_ack',
+                'data': {
+                    'order_id': order['id'],
+                    'message': 'Order amended successfully',
+                    'symbol': symbol,
+                    'price': ticks_to_float(symbol, order['price']),
+                    'remaining_quantity': order['remaining_quantity'],
+                    'matches': len(result['matches'])
+                }
+            }))
+
+        except (ValueError, TypeError, ArithmeticError) as e:
+            await self.send_order_error(f'Invalid amend request: {str(e)}')
+        except Exception as e:
+            await self.send_order_error('Failed to amend order')
+
+    async def handle_subscription(self, subscription_data, subscribe):
+        try:
+            symbol = normalize_symbol(subscription_data.get('symbol'))
+        except ValueError as e:
+            await self.send_error(str(e))
+            return
+
+        await self.send(text_data=json.dumps({
+            'type': 'subscribed' if subscribe else 'unsubscribed',
+            'data': {'symbol': symbol}
+        }))
+        if subscribe:
+            await gateway.subscribe_orderbook(self.channel_name, symbol, self.outbound)
+        else:
+            await gateway.unsubscribe_orderbook(self.channel_name, symbol)
+
+    async def handle_snapshot_request(self, request_data):
+        try:
+            symbol = normalize_symbol(request_data.get('symbol'))
+        except ValueError as e:
+            await self.send_error(str(e))
+            return
+
+        await gateway.send_orderbook_snapshot(symbol, self.outbound)
+
+    async def send_frame(self, frame):
+        await self.send(text_data=frame)
+
+    def drop_slow_connection(self):
+        # Called by the outbound queue once this socket is too far behind;
+        # disconnect() then unsubscribes it.
+        asyncio.create_task(self.close(code=4008))
 
     async def user_update(self, event):
         try:
             current_user = self.scope.get('user')
             if current_user and current_user.is_authenticated and event.get("user_id") == current_user.id:
-                await self.send(text_data=event["message"])
+                self.outbound.put(event["message"])
         except Exception as e:
             logger.error(f"Error sending user update: {e}")
 
@@ -160,12 +351,12 @@ class TradingConsumer(AsyncWebsocketConsumer):
                 if user.balance >= required_amount:
                     user.balance -= required_amount
                     user.save()
-                    return True
-                return False
+                    return user.balance
+                return None
         except User.DoesNotExist:
-            return False
+            return None
         except Exception as e:
-            return False
+            return None
 
     @database_sync_to_async
     def deduct_holdings_for_sell_order(self, user_id, symbol, quantity):
@@ -180,12 +371,12 @@ class TradingConsumer(AsyncWebsocketConsumer):
                     else:
                         holding.total = holding.quantity * holding.price
                         holding.save()
-                    return True
-                return False
+                    return holding
+                return None
         except Holding.DoesNotExist:
-            return False
+            return None
         except Exception as e:
-            return False
+            return None
 
     @database_sync_to_async
     def get_user_by_id(self, user_id):
@@ -0,0 +1,193 @@
+import asyncio
+import logging
+import zlib
+from typing import Dict, Iterable, List, Optional
+
+from django.conf import settings
+
+from .matching_engine import candle_topic, matching_engine, normalize_symbol
+from .order_book import OrderBook
+from .portfolio import portfolio_cache
+
+logger = logging.getLogger(__name__)
+
+# Workers send requests to one channel per shard; the engine process serving
+# that shard is its only reader.
+ENGINE_CHANNEL = 'trading.engine'
+
+
+def engine_channel(shard: int) -> str:
+    return f'{ENGINE_CHANNEL}.{shard}'
+
+
+def shard_for(symbol: str) -> int:
+    # Explicit assignments win; everything else is spread by a hash that is
+    # stable across processes and restarts.
+    shard = settings.TRADING_SHARD_ASSIGNMENTS.get(symbol)
+    if shard is None:
+        shard = zlib.crc32(symbol.encode()) % settings.TRADING_ENGINE_SHARDS
+    return shard
+
+
+def orderbook_group(symbol: str) -> str:
+    return f'orderbook.{symbol}'
+
+
+class OrderbookRelay:
+    # Takes the place of a socket in the engine's fan-out hub and forwards each
+    # frame for one symbol, order book and candles alike, to the workers'
+    # channel-layer group with the hub topic it was published under. Only the
+    # delta is sent; a worker that conflated some away asks for a snapshot.
+    # Snapshot replies to workers go through the same queue, so a worker
+    # always sees a snapshot after every delta it already covers.
+    def __init__(self, channel_layer, book: OrderBook):
+        self.channel_layer = channel_layer
+        self.book = book
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    def put(self, frame: str, key: Optional[str] = None, supersede=None):
+        self._queue.put_nowait((None, {
+            'type': 'orderbook.frame',
+            'symbol': self.book.symbol,
+            'topic': key,
+            'message': frame
+        }))
+
+    def put_reply(self, channel_name: str, reply: Dict):
+        self._queue.put_nowait((channel_name, reply))
+
+    async def _run(self):
+        group = orderbook_group(self.book.symbol)
+        while True:
+            channel_name, message = await self._queue.get()
+            try:
+                if channel_name is None:
+                    await self.channel_layer.group_send(group, message)
+                else:
+                    await self.channel_layer.send(channel_name, message)
+            except Exception as e:
+                logger.error(f"Error relaying {self.book.symbol} orderbook: {e}")
+
+
+class EngineServer:
+    # Serves the matching engine to ASGI workers over the channel layer, for
+    # the symbols of `shards`. Requests arrive on each shard's channel as
+    # {'op', 'args', 'request_id', 'reply_to'} and are answered with an
+    # `engine.reply` on `reply_to`; requests without `reply_to` are
+    # notifications. Order book frames go out to one group per symbol, joined
+    # by every worker with a subscriber.
+    def __init__(self, channel_layer, shards: Iterable[int]):
+        self.channel_layer = channel_layer
+        self.shards = set(shards)
+        self.relays: Dict[str, OrderbookRelay] = {}
+
+    async def serve(self):
+        matching_engine.owns_symbol = lambda symbol: shard_for(symbol) in self.shards
+        if len(self.shards) < settings.TRADING_ENGINE_SHARDS:
+            matching_engine.settled_listener = self._share_settled
+        await matching_engine.start()
+        await asyncio.gather(*(self._serve_channel(engine_channel(shard)) for shard in sorted(self.shards)))
+
+    async def _serve_channel(self, channel: str):
+        logger.info(f"Engine serving on {channel}")
+        while True:
+            message = await self.channel_layer.receive(channel)
+            # Each request runs as its own task, so requests are not applied
+            # strictly in the order they were received: an order whose account
+            # the ledger has to load first reaches its sequencer after that
+            # read, behind orders received later. The orders of one basket
+            # keep their order.
+            asyncio.create_task(self._handle(message))
+
+    async def _handle(self, message: Dict):
+        reply = {'type': 'engine.reply', 'request_id': message.get('request_id')}
+        try:
+            op = message['op']
+            args = message.get('args', {})
+            if op == 'snapshot':
+                self._check_owned(args['symbol'])
+                relay = self._snapshot_relay(args['symbol'], args['subscribe'])
+                reply['result'] = self._snapshot(args['symbol'])
+                reply['candles'] = matching_engine.get_candle_snapshot(args['symbol'])
+                if relay is not None and message.get('reply_to'):
+                    relay.put_reply(message['reply_to'], reply)
+                    return
+            else:
+                handler = getattr(self, f'op_{op}', None)
+                if handler is None:
+                    raise ValueError(f'Unknown engine op: {op}')
+                reply['result'] = await handler(**args)
+        except Exception as e:
+            if not isinstance(e, ValueError):
+                logger.error(f"Error handling engine request {message.get('op')}: {e}", exc_info=True)
+            reply['error'] = str(e)
+            reply['error_type'] = 'ValueError' if isinstance(e, ValueError) else 'RuntimeError'
+
+        if message.get('reply_to'):
+            await self.channel_layer.send(message['reply_to'], reply)
+
+    def _check_owned(self, symbol: str):
+        if shard_for(normalize_symbol(symbol)) not in self.shards:
+            raise ValueError(f'{symbol} is not served by this engine process')
+
+    def _share_settled(self, user_ids: set):
+        # Other shards cache the same users; their copies are now stale.
+        for shard in range(settings.TRADING_ENGINE_SHARDS):
+            if shard not in self.shards:
+                asyncio.create_task(self.channel_layer.send(engine_channel(shard), {
+                    'type': 'engine.request',
+                    'op': 'portfolios_changed',
+                    'args': {'user_ids': list(user_ids)}
+                }))
+
+    def _snapshot_relay(self, symbol: str, subscribe: bool) -> Optional[OrderbookRelay]:
+        relay = self.relays.get(symbol)
+        if relay is None and subscribe:
+            relay = OrderbookRelay(self.channel_layer, matching_engine.get_book(symbol))
+            self.relays[symbol] = relay
+            matching_engine.orderbook_hub.subscribe(symbol, 'relay', relay)
+            matching_engine.orderbook_hub.subscribe(candle_topic(symbol), 'relay', relay)
+        return relay
+
+    def _snapshot(self, symbol: str) -> str:
+        return matching_engine.get_orderbook_snapshot(symbol)
+
+    async def op_add_order(self, order):
+        self._check_owned(order['symbol'])
+        return await matching_engine.add_order(order)
+
+    async def op_add_orders(self, orders):
+        for order in orders:
+            self._check_owned(order['symbol'])
+        results = await matching_engine.add_orders(orders)
+        return [{'exception': str(result)} if isinstance(result, Exception) else result for result in results]
+
+    async def op_cancel_order(self, symbol, order_id, user_id):
+        self._check_owned(symbol)
+        return await matching_engine.cancel_order(symbol, order_id, user_id)
+
+    async def op_amend_order(self, symbol, order_id, user_id, price=None, quantity=None, reserved_extra=0):
+        self._check_owned(symbol)
+        return await matching_engine.amend_order(
+            symbol, order_id, user_id, price=price, quantity=quantity, reserved_extra=reserved_extra
+        )
+
+    async def op_get_order(self, symbol, order_id):
+        return matching_engine.get_order(symbol, order_id)
+
+    async def op_consumer_joined(self, channel_name):
+        matching_engine.add_trading_consumer(channel_name)
+
+    async def op_consumer_left(self, channel_name):
+        matching_engine.remove_trading_consumer(channel_name)
+
+    async def op_portfolio_changed(self, user_id):
+        portfolio_cache.invalidate(user_id)
+
+    async def op_portfolios_changed(self, user_ids: List[int]):
+        for user_id in user_ids:
+            portfolio_cache.invalidate(user_id)
+
+    async def op_stats(self):
+        return matching_engine.get_stats()
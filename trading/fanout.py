@@ -0,0 +1,92 @@
+import logging
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional
+
+from .outbound import OutboundQueue
+
+logger = logging.getLogger(__name__)
+
+
+class FanoutHub:
+    # In-process publish/subscribe for market data. Each subscriber registers
+    # its connection's OutboundQueue under a topic; a published frame is
+    # encoded once by the caller and put on every queue directly, without a
+    # channel-layer message per socket. Frames are conflated per topic, so a
+    # socket that falls behind gets `supersede()` (normally a fresh snapshot)
+    # instead of a backlog, or, without one, just the newest frame; publish()
+    # then reports how many subscribers have a gap to resync. Putting never
+    # waits on a socket, so publish() is synchronous and one slow subscriber
+    # cannot hold up the rest. Frames published with `conflate=False` are
+    # queued in order like any plain frame, for events that must all arrive.
+    def __init__(self):
+        self._topics: Dict[str, Dict[str, OutboundQueue]] = defaultdict(dict)
+        self.published = 0
+        self.delivered = 0
+        self.failed = 0
+        self.last_publish_ms = 0.0
+        self.last_fanout = 0
+        self.per_subscriber_us = 0.0
+
+    def subscribe(self, topic: str, key: str, outbound: OutboundQueue):
+        self._topics[topic][key] = outbound
+
+    def unsubscribe(self, topic: str, key: str):
+        outbounds = self._topics.get(topic)
+        if outbounds is None:
+            return
+        outbounds.pop(key, None)
+        if not outbounds:
+            del self._topics[topic]
+
+    def unsubscribe_all(self, key: str):
+        for topic in list(self._topics):
+            self.unsubscribe(topic, key)
+
+    def subscribers(self, topic: str) -> List[OutboundQueue]:
+        return list(self._topics.get(topic, {}).values())
+
+    def topics(self) -> List[str]:
+        return list(self._topics)
+
+    def subscriber_count(self, topic: str) -> int:
+        return len(self._topics.get(topic, ()))
+
+    def stats(self) -> Dict:
+        return {
+            'topics': {topic: len(outbounds) for topic, outbounds in self._topics.items()},
+            'published': self.published,
+            'delivered': self.delivered,
+            'failed': self.failed,
+            'last_publish_ms': round(self.last_publish_ms, 3),
+            'last_fanout': self.last_fanout,
+            'per_subscriber_us': round(self.per_subscriber_us, 3),
+        }
+
+    def publish(self, topic: str, frame: str, supersede: Optional[Callable[[], str]] = None,
+                conflate: bool = True) -> int:
+        outbounds = self._topics.get(topic)
+        if not outbounds:
+            return 0
+        targets = list(outbounds.values())
+        key = topic if conflate else None
+        gaps = 0
+        started = time.perf_counter()
+        for outbound in targets:
+            try:
+                outbound.put(frame, key, supersede)
+                self.delivered += 1
+                if topic in outbound.gaps:
+                    gaps += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Error delivering frame: {e}")
+        elapsed = time.perf_counter() - started
+
+        self.published += 1
+        self.last_publish_ms = elapsed * 1000
+        self.last_fanout = len(targets)
+        # Smoothed cost of one delivery, for sizing broadcast capacity.
+        sample = elapsed * 1_000_000 / len(targets)
+        self.per_subscriber_us = sample if self.published == 1 else 0.9 * self.per_subscriber_us + 0.1 * sample
+        return gaps
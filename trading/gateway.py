@@ -0,0 +1,361 @@
+import asyncio
+import itertools
+import logging
+from decimal import Decimal
+from typing import Any, Dict, List, Optional
+
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from django.conf import settings
+
+from accounts.models import Holding
+from .engine_server import EngineServer, engine_channel, orderbook_group, shard_for
+from .fanout import FanoutHub
+from .matching_engine import candle_topic, matching_engine, normalize_symbol
+from .outbound import OutboundQueue
+from .portfolio import portfolio_cache
+
+logger = logging.getLogger(__name__)
+
+# Channel-layer group memberships expire (a day by default), so workers
+# re-join the groups they still need well before that.
+GROUP_REFRESH_SECONDS = 3600
+
+# Portfolio writes committed by a process that does not host an embedded
+# engine are announced here, for the host to drop its cached copy.
+PORTFOLIO_CHANNEL = 'trading.portfolios'
+
+
+def shared_channel_layer() -> bool:
+    # An in-memory layer only reaches the process it lives in.
+    return not isinstance(get_channel_layer(), InMemoryChannelLayer)
+
+
+class LocalGateway:
+    # The engine lives in the ASGI server: the default single-process
+    # topology. That server marks itself with host() (see app/asgi.py); any
+    # other process serving the REST API, such as runserver, has no engine it
+    # can reach, and only tells the host about portfolio writes when the
+    # channel layer is shared.
+    def __init__(self):
+        self.hosts_engine = False
+        self._listener = None
+
+    def host(self):
+        self.hosts_engine = True
+
+    @property
+    def available(self) -> bool:
+        return self.hosts_engine
+
+    @property
+    def orderbook_hub(self) -> FanoutHub:
+        return matching_engine.orderbook_hub
+
+    async def start(self):
+        await matching_engine.start()
+        if self._listener is None and self.hosts_engine and shared_channel_layer():
+            self._listener = asyncio.create_task(self._receive_portfolio_changes())
+
+    async def _receive_portfolio_changes(self):
+        channel_layer = get_channel_layer()
+        while True:
+            try:
+                message = await channel_layer.receive(PORTFOLIO_CHANNEL)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error receiving portfolio changes: {e}")
+                await asyncio.sleep(1)
+                continue
+            portfolio_cache.invalidate(message['user_id'])
+
+    async def add_order(self, order_data: Dict) -> Dict:
+        return await matching_engine.add_order(order_data)
+
+    async def add_orders(self, orders_data: List[Dict]) -> List[Any]:
+        return await matching_engine.add_orders(orders_data)
+
+    async def cancel_order(self, symbol: str, order_id: int, user_id: int) -> Dict:
+        return await matching_engine.cancel_order(symbol, order_id, user_id)
+
+    async def amend_order(self, symbol: str, order_id: int, user_id: int, price=None, quantity=None,
+                          reserved_extra: int = 0) -> Dict:
+        return await matching_engine.amend_order(
+            symbol, order_id, user_id, price=price, quantity=quantity, reserved_extra=reserved_extra
+        )
+
+    async def get_order(self, symbol: str, order_id: int) -> Optional[Dict]:
+        return matching_engine.get_order(symbol, order_id)
+
+    async def subscribe_orderbook(self, channel_name: str, symbol: str, outbound: OutboundQueue):
+        matching_engine.subscribe_orderbook(channel_name, symbol, outbound)
+
+    async def unsubscribe_orderbook(self, channel_name: str, symbol: str):
+        matching_engine.unsubscribe_orderbook(channel_name, symbol)
+
+    async def send_orderbook_snapshot(self, symbol: str, outbound: OutboundQueue):
+        outbound.put(matching_engine.get_orderbook_snapshot(symbol), symbol)
+
+    async def add_trading_consumer(self, channel_name: str):
+        matching_engine.add_trading_consumer(channel_name)
+
+    async def remove_trading_consumer(self, channel_name: str):
+        matching_engine.remove_trading_consumer(channel_name)
+
+    async def portfolio_changed(self, user_id: int, balance: Optional[Decimal] = None,
+                                holdings: Optional[Dict[str, Optional[Holding]]] = None):
+        if not self.hosts_engine:
+            # The cache to update is the host's; it reloads the portfolio on
+            # next use.
+            if shared_channel_layer():
+                await get_channel_layer().send(PORTFOLIO_CHANNEL, {'type': 'portfolio.changed', 'user_id': user_id})
+            return
+        if balance is not None:
+            portfolio_cache.set_balance(user_id, balance)
+        for symbol, holding in (holdings or {}).items():
+            portfolio_cache.set_holding(user_id, symbol, holding)
+
+    async def get_stats(self) -> Dict:
+        return matching_engine.get_stats()
+
+
+class RemoteGateway:
+    # The engine runs in its own processes (`manage.py run_engine --shard N`),
+    # each owning the books of one shard of the symbols, and this worker only
+    # terminates WebSockets. Requests are routed to the channel of the
+    # symbol's shard with this worker's channel as `reply_to`; order book
+    # frames from every shard arrive on the same channel through the symbol
+    # groups and are fanned out to local sockets by this worker's own hub.
+    # Only deltas are relayed; when a slow socket has some conflated away, one
+    # snapshot per symbol is requested and put in their place.
+    # With an in-memory channel layer nothing outside the process can answer,
+    # so an engine server for all shards is started in-process as a stand-in.
+    # Engine processes are reached over the channel layer, so every process
+    # can use them and none hosts one.
+    hosts_engine = False
+    available = True
+
+    def __init__(self):
+        self.orderbook_hub = FanoutHub()
+        self.channel = None
+        self._loop = None
+        self._start_task = None
+        self._request_ids = itertools.count(1)
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._snapshot_requests: Dict[int, tuple] = {}
+        self._resyncs = set()
+        # Sockets per symbol, including ones still waiting for their snapshot;
+        # the worker stays in a symbol's group while this is non-empty.
+        self._subscriptions: Dict[str, set] = {}
+
+    def host(self):
+        pass
+
+    async def start(self):
+        if self._start_task is None:
+            self._start_task = asyncio.create_task(self._start())
+        await self._start_task
+
+    async def _start(self):
+        channel_layer = get_channel_layer()
+        if isinstance(channel_layer, InMemoryChannelLayer):
+            logger.warning("TRADING_ENGINE_MODE=remote with an in-memory channel layer; serving the engine in-process")
+            asyncio.create_task(EngineServer(channel_layer, range(settings.TRADING_ENGINE_SHARDS)).serve())
+        self.channel = await channel_layer.new_channel()
+        self._loop = asyncio.get_running_loop()
+        asyncio.create_task(self._receive())
+        asyncio.create_task(self._refresh_groups())
+
+    async def _receive(self):
+        channel_layer = get_channel_layer()
+        while True:
+            try:
+                message = await channel_layer.receive(self.channel)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error receiving from the engine: {e}")
+                await asyncio.sleep(1)
+                continue
+
+            if message['type'] == 'orderbook.frame':
+                if self.orderbook_hub.publish(message['topic'], message['message']):
+                    self._request_resync(message['symbol'])
+            elif message['type'] == 'engine.reply':
+                request_id = message['request_id']
+                # A snapshot is queued, and the socket subscribed, before the
+                # next frame is read, so no delta falls between the two.
+                snapshot_request = self._snapshot_requests.pop(request_id, None)
+                if snapshot_request is not None and 'error' not in message:
+                    channel_name, symbol, outbound, subscribe = snapshot_request
+                    if outbound is None:
+                        self._resync(symbol, message['result'], message['candles'])
+                        continue
+                    outbound.put(message['result'], symbol)
+                    outbound.put(message['candles'], candle_topic(symbol))
+                    if subscribe and channel_name in self._subscriptions.get(symbol, ()):
+                        self.orderbook_hub.subscribe(symbol, channel_name, outbound)
+                        self.orderbook_hub.subscribe(candle_topic(symbol), channel_name, outbound)
+                future = self._pending.get(request_id)
+                if future is not None and not future.done():
+                    future.set_result(message)
+
+    def _request_resync(self, symbol: str):
+        if symbol not in self._resyncs:
+            self._resyncs.add(symbol)
+            asyncio.create_task(self._fetch_resync(symbol))
+
+    async def _fetch_resync(self, symbol: str):
+        try:
+            await self._request(
+                'snapshot', shard_for(symbol), snapshot_request=(None, symbol, None, False),
+                symbol=symbol, subscribe=False
+            )
+        except Exception as e:
+            logger.error(f"Error resyncing {symbol} orderbook: {e}")
+        finally:
+            self._resyncs.discard(symbol)
+
+    def _resync(self, symbol: str, snapshot: str, candles: str):
+        # Sockets that lost deltas since the request get the snapshot in place
+        # of their pending frame; it covers every delta read before it.
+        self._resyncs.discard(symbol)
+        for outbound in self.orderbook_hub.subscribers(symbol):
+            outbound.resync(symbol, snapshot)
+        for outbound in self.orderbook_hub.subscribers(candle_topic(symbol)):
+            outbound.resync(candle_topic(symbol), candles)
+
+    async def _refresh_groups(self):
+        channel_layer = get_channel_layer()
+        while True:
+            await asyncio.sleep(GROUP_REFRESH_SECONDS)
+            for symbol in list(self._subscriptions):
+                try:
+                    await channel_layer.group_add(orderbook_group(symbol), self.channel)
+                except Exception as e:
+                    logger.error(f"Error refreshing {symbol} orderbook group: {e}")
+
+    async def _request(self, op: str, shard: int, snapshot_request: tuple = None, **args):
+        channel_layer = get_channel_layer()
+        message = {'type': 'engine.request', 'op': op, 'args': args}
+        timeout = settings.TRADING_ENGINE_TIMEOUT_SECONDS
+
+        if self._loop is not asyncio.get_running_loop():
+            # Called outside the worker's own loop (a sync view behind
+            # async_to_sync): wait for the reply on a channel of its own.
+            reply_to = await channel_layer.new_channel()
+            message.update(request_id=0, reply_to=reply_to)
+            await channel_layer.send(engine_channel(shard), message)
+            reply = await asyncio.wait_for(channel_layer.receive(reply_to), timeout)
+        else:
+            request_id = next(self._request_ids)
+            future = self._loop.create_future()
+            self._pending[request_id] = future
+            if snapshot_request is not None:
+                self._snapshot_requests[request_id] = snapshot_request
+            message.update(request_id=request_id, reply_to=self.channel)
+            try:
+                await channel_layer.send(engine_channel(shard), message)
+                reply = await asyncio.wait_for(future, timeout)
+            finally:
+                self._pending.pop(request_id, None)
+                self._snapshot_requests.pop(request_id, None)
+
+        if 'error' in reply:
+            error_type = ValueError if reply.get('error_type') == 'ValueError' else RuntimeError
+            raise error_type(reply['error'])
+        return reply['result']
+
+    async def _notify_all(self, op: str, **args):
+        channel_layer = get_channel_layer()
+        for shard in range(settings.TRADING_ENGINE_SHARDS):
+            await channel_layer.send(engine_channel(shard), {'type': 'engine.request', 'op': op, 'args': args})
+
+    async def add_order(self, order_data: Dict) -> Dict:
+        shard = shard_for(normalize_symbol(order_data['symbol']))
+        return await self._request('add_order', shard, order=order_data)
+
+    async def add_orders(self, orders_data: List[Dict]) -> List[Any]:
+        # One request per shard, all in flight together; results are put
+        # back in basket order.
+        by_shard: Dict[int, List[int]] = {}
+        for index, order_data in enumerate(orders_data):
+            by_shard.setdefault(shard_for(normalize_symbol(order_data['symbol'])), []).append(index)
+        replies = await asyncio.gather(*(
+            self._request('add_orders', shard, orders=[orders_data[index] for index in indexes])
+            for shard, indexes in by_shard.items()
+        ), return_exceptions=True)
+
+        results: List[Any] = [None] * len(orders_data)
+        for indexes, reply in zip(by_shard.values(), replies):
+            for position, index in enumerate(indexes):
+                if isinstance(reply, Exception):
+                    results[index] = reply
+                elif 'exception' in reply[position]:
+                    results[index] = RuntimeError(reply[position]['exception'])
+                else:
+                    results[index] = reply[position]
+        return results
+
+    async def cancel_order(self, symbol: str, order_id: int, user_id: int) -> Dict:
+        return await self._request('cancel_order', shard_for(symbol), symbol=symbol, order_id=order_id, user_id=user_id)
+
+    async def amend_order(self, symbol: str, order_id: int, user_id: int, price=None, quantity=None,
+                          reserved_extra: int = 0) -> Dict:
+        return await self._request(
+            'amend_order', shard_for(symbol), symbol=symbol, order_id=order_id, user_id=user_id,
+            price=price, quantity=quantity, reserved_extra=reserved_extra
+        )
+
+    async def get_order(self, symbol: str, order_id: int) -> Optional[Dict]:
+        return await self._request('get_order', shard_for(symbol), symbol=symbol, order_id=order_id)
+
+    async def subscribe_orderbook(self, channel_name: str, symbol: str, outbound: OutboundQueue):
+        subscribers = self._subscriptions.setdefault(symbol, set())
+        subscribers.add(channel_name)
+        if len(subscribers) == 1:
+            await get_channel_layer().group_add(orderbook_group(symbol), self.channel)
+        await self._request(
+            'snapshot', shard_for(symbol), snapshot_request=(channel_name, symbol, outbound, True),
+            symbol=symbol, subscribe=True
+        )
+
+    async def unsubscribe_orderbook(self, channel_name: str, symbol: str):
+        self.orderbook_hub.unsubscribe(symbol, channel_name)
+        self.orderbook_hub.unsubscribe(candle_topic(symbol), channel_name)
+        subscribers = self._subscriptions.get(symbol)
+        if subscribers is None or channel_name not in subscribers:
+            return
+        subscribers.discard(channel_name)
+        if not subscribers:
+            del self._subscriptions[symbol]
+            await get_channel_layer().group_discard(orderbook_group(symbol), self.channel)
+
+    async def send_orderbook_snapshot(self, symbol: str, outbound: OutboundQueue):
+        await self._request(
+            'snapshot', shard_for(symbol), snapshot_request=(None, symbol, outbound, False),
+            symbol=symbol, subscribe=False
+        )
+
+    async def add_trading_consumer(self, channel_name: str):
+        await self._notify_all('consumer_joined', channel_name=channel_name)
+
+    async def remove_trading_consumer(self, channel_name: str):
+        for symbol in list(self._subscriptions):
+            await self.unsubscribe_orderbook(channel_name, symbol)
+        await self._notify_all('consumer_left', channel_name=channel_name)
+
+    async def portfolio_changed(self, user_id: int, balance: Optional[Decimal] = None,
+                                holdings: Optional[Dict[str, Optional[Holding]]] = None):
+        # Every shard caches the user; each reloads the portfolio on next use.
+        await self._notify_all('portfolio_changed', user_id=user_id)
+
+    async def get_stats(self) -> Dict:
+        shards = range(settings.TRADING_ENGINE_SHARDS)
+        stats = await asyncio.gather(*(self._request('stats', shard) for shard in shards))
+        if len(stats) == 1:
+            return stats[0]
+        return {'shards': {str(shard): shard_stats for shard, shard_stats in zip(shards, stats)}}
+
+
+gateway = RemoteGateway() if settings.TRADING_ENGINE_MODE == 'remote' else LocalGateway()
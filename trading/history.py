@@ -0,0 +1,123 @@
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.db.models import Q
+
+from .models import Order, Trade
+
+# History is paged newest first by (timestamp, id), the key of the indexes in
+# trading.models. A page ends with the cursor of its last row; passing it back
+# as `before` continues from there with an index range scan, however deep the
+# page, where an OFFSET would read and discard every row before it. A user's
+# fills add the side to the key, since a self-trade is both a buy and a sell
+# row of the same trade.
+TRADE_FIELDS = ('id', 'symbol', 'trade_id', 'price', 'quantity', 'total_amount', 'executed_at')
+ORDER_FIELDS = ('id', 'symbol', 'order_id', 'order_type', 'price', 'quantity', 'filled_quantity', 'status',
+                'created_at', 'closed_at')
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+def encode_cursor(moment: datetime, row_id: int, side: str = '') -> str:
+    micros = (moment - _EPOCH) // _MICROSECOND
+    return f'{micros}_{row_id}_{side}' if side else f'{micros}_{row_id}'
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int, str]:
+    try:
+        parts = cursor.split('_')
+        micros, row_id = int(parts[0]), int(parts[1])
+    except (AttributeError, IndexError, ValueError):
+        raise ValueError('Invalid cursor')
+    side = parts[2] if len(parts) == 3 else ''
+    if len(parts) > 3 or side not in ('', 'BUY', 'SELL'):
+        raise ValueError('Invalid cursor')
+    return _EPOCH + micros * _MICROSECOND, row_id, side
+
+
+def page_limit(limit) -> int:
+    if limit is None:
+        return settings.TRADING_HISTORY_PAGE_SIZE
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        raise ValueError('limit must be a whole number')
+    if limit <= 0:
+        raise ValueError('limit must be positive')
+    return min(limit, settings.TRADING_HISTORY_MAX_PAGE_SIZE)
+
+
+def _before(field: str, cursor: Optional[str], side: str = '') -> Q:
+    # Rows of `side` that come after the cursor, newest first; sides sort
+    # SELL before BUY.
+    if not cursor:
+        return Q()
+    moment, row_id, cursor_side = decode_cursor(cursor)
+    before = Q(**{f'{field}__lt': moment}) | Q(**{field: moment, 'id__lt': row_id})
+    if side and side < cursor_side:
+        before |= Q(**{field: moment, 'id': row_id})
+    return before
+
+
+def _page(rows: List[Dict], limit: int, field: str) -> Dict:
+    rows = rows[:limit + 1]
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        'results': rows,
+        'next_cursor': encode_cursor(rows[-1][field], rows[-1]['id'], rows[-1].get('side', '')) if has_more else None
+    }
+
+
+def _serialize(row: Dict) -> Dict:
+    for name, value in row.items():
+        if isinstance(value, datetime):
+            row[name] = value.isoformat()
+        elif name in ('price', 'total_amount'):
+            row[name] = float(value)
+    return row
+
+
+def symbol_trades(symbol: str, limit: int, cursor: Optional[str] = None) -> Dict:
+    rows = list(
+        Trade.objects.filter(_before('executed_at', cursor), symbol=symbol)
+        .order_by('-executed_at', '-id')
+        .values(*TRADE_FIELDS)[:limit + 1]
+    )
+    page = _page(rows, limit, 'executed_at')
+    page['results'] = [_serialize(row) for row in page['results']]
+    return page
+
+
+def user_trades(user_id: int, limit: int, cursor: Optional[str] = None) -> Dict:
+    # A user's fills are the trades they bought in plus the ones they sold
+    # in. Each side is read from its own index and the two pages are merged,
+    # which keeps both reads range scans instead of one OR over two columns.
+    rows = []
+    for side, field in (('BUY', 'buyer_id'), ('SELL', 'seller_id')):
+        for row in (
+            Trade.objects.filter(_before('executed_at', cursor, side), **{field: user_id})
+            .order_by('-executed_at', '-id')
+            .values(*TRADE_FIELDS, 'buy_order_id', 'sell_order_id')[:limit + 1]
+        ):
+            buy_order_id, sell_order_id = row.pop('buy_order_id'), row.pop('sell_order_id')
+            row['side'] = side
+            row['order_id'] = buy_order_id if side == 'BUY' else sell_order_id
+            rows.append(row)
+    rows.sort(key=lambda row: (row['executed_at'], row['id'], row['side']), reverse=True)
+
+    page = _page(rows, limit, 'executed_at')
+    page['results'] = [_serialize(row) for row in page['results']]
+    return page
+
+
+def user_orders(user_id: int, limit: int, cursor: Optional[str] = None) -> Dict:
+    rows = list(
+        Order.objects.filter(_before('closed_at', cursor), user_id=user_id)
+        .order_by('-closed_at', '-id')
+        .values(*ORDER_FIELDS)[:limit + 1]
+    )
+    page = _page(rows, limit, 'closed_at')
+    page['results'] = [_serialize(row) for row in page['results']]
+    return page
@@ -0,0 +1,143 @@
+import json
+import logging
+import os
+from decimal import Decimal
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple, Any
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FILE = 'snapshot.json'
+SEGMENT_PREFIX = 'journal-'
+SEGMENT_SUFFIX = '.log'
+
+
+def _encode_default(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+class EngineJournal:
+    # Append-only log of engine commands, one directory per symbol. Commands
+    # are written as JSON lines to the current segment before they are
+    # applied. A snapshot of the book at sequence S starts a new segment, and
+    # segments that only hold commands up to S are then deleted, so recovery
+    # is "load snapshot, replay the remaining segments".
+    def __init__(self, root, fsync: bool = False):
+        self.root = Path(root)
+        self.fsync = fsync
+        self._segments: Dict[str, Any] = {}
+
+    def _symbol_dir(self, symbol: str) -> Path:
+        return self.root / symbol
+
+    def _segment_path(self, symbol: str, first_seq: int) -> Path:
+        return self._symbol_dir(symbol) / f'{SEGMENT_PREFIX}{first_seq:012d}{SEGMENT_SUFFIX}'
+
+    def _segment_paths(self, symbol: str) -> List[Path]:
+        directory = self._symbol_dir(symbol)
+        if not directory.is_dir():
+            return []
+        return sorted(
+            path for path in directory.iterdir()
+            if path.name.startswith(SEGMENT_PREFIX) and path.name.endswith(SEGMENT_SUFFIX)
+        )
+
+    def symbols(self) -> List[str]:
+        if not self.root.is_dir():
+            return []
+        return sorted(path.name for path in self.root.iterdir() if path.is_dir())
+
+    def append(self, symbol: str, seq: int, kind: str, payload: Dict):
+        segment = self._segments.get(symbol)
+        if segment is None:
+            self._symbol_dir(symbol).mkdir(parents=True, exist_ok=True)
+            segment = open(self._segment_path(symbol, seq), 'a', encoding='utf-8')
+            self._segments[symbol] = segment
+        segment.write(json.dumps([seq, kind, payload], default=_encode_default, separators=(',', ':')))
+        segment.write('\n')
+
+    def flush(self, symbol: str):
+        segment = self._segments.get(symbol)
+        if segment is None:
+            return
+        segment.flush()
+        if self.fsync:
+            os.fsync(segment.fileno())
+
+    def position(self, symbol: str) -> int:
+        # Where the next append to `symbol` lands; see rollback().
+        segment = self._segments.get(symbol)
+        return segment.tell() if segment is not None else 0
+
+    def rollback(self, symbol: str, position: int):
+        # Drops everything appended since `position`, whether it is still
+        # buffered or already on disk, so a batch that failed to journal is
+        # never replayed.
+        segment = self._segments.pop(symbol, None)
+        if segment is None:
+            return
+        try:
+            segment.close()
+        except OSError:
+            pass
+        os.truncate(segment.name, position)
+        self._segments[symbol] = open(segment.name, 'a', encoding='utf-8')
+
+    def rotate(self, symbol: str, next_seq: int):
+        self.close(symbol)
+        self._symbol_dir(symbol).mkdir(parents=True, exist_ok=True)
+        self._segments[symbol] = open(self._segment_path(symbol, next_seq), 'a', encoding='utf-8')
+
+    def close(self, symbol: str):
+        segment = self._segments.pop(symbol, None)
+        if segment is not None:
+            segment.flush()
+            if self.fsync:
+                os.fsync(segment.fileno())
+            segment.close()
+
+    def write_snapshot(self, symbol: str, seq: int, state: Dict):
+        directory = self._symbol_dir(symbol)
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / SNAPSHOT_FILE
+        tmp_path = directory / f'{SNAPSHOT_FILE}.tmp'
+
+        with open(tmp_path, 'w', encoding='utf-8') as snapshot_file:
+            json.dump({'seq': seq, 'state': state}, snapshot_file, default=_encode_default, separators=(',', ':'))
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(tmp_path, path)
+
+        # Every segment but the newest one started at or before `seq` and was
+        # closed by the rotation that preceded this snapshot.
+        for segment_path in self._segment_paths(symbol):
+            first_seq = int(segment_path.name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+            if first_seq <= seq:
+                segment_path.unlink(missing_ok=True)
+
+    def load(self, symbol: str) -> Tuple[int, Optional[Dict], Iterator[Tuple[int, str, Dict]]]:
+        snapshot_seq = 0
+        state = None
+        path = self._symbol_dir(symbol) / SNAPSHOT_FILE
+        if path.exists():
+            with open(path, encoding='utf-8') as snapshot_file:
+                snapshot = json.load(snapshot_file)
+            snapshot_seq = snapshot['seq']
+            state = snapshot['state']
+
+        return snapshot_seq, state, self._entries(symbol, snapshot_seq)
+
+    def _entries(self, symbol: str, after_seq: int) -> Iterator[Tuple[int, str, Dict]]:
+        for segment_path in self._segment_paths(symbol):
+            with open(segment_path, encoding='utf-8') as segment:
+                for line in segment:
+                    try:
+                        seq, kind, payload = json.loads(line)
+                    except ValueError:
+                        # A torn final write from a crash; nothing after it was applied.
+                        logger.warning(f"Ignoring truncated journal entry in {segment_path}")
+                        break
+                    if seq > after_seq:
+                        yield seq, kind, payload
@@ -0,0 +1,170 @@
+import asyncio
+from decimal import Decimal
+from typing import Dict, List, Optional
+
+from channels.db import database_sync_to_async
+from django.contrib.auth import get_user_model
+
+from accounts.models import Holding
+from .ticks import from_ticks
+
+User = get_user_model()
+
+
+class Account:
+    # `inflight` counts reservations whose `reserve` event is not settled yet.
+    __slots__ = ('user_id', 'cash', 'positions', 'inflight')
+
+    def __init__(self, user_id: int, cash: Decimal, positions: Dict[str, int]):
+        self.user_id = user_id
+        self.cash = cash
+        self.positions = positions
+        self.inflight = 0
+
+
+class ReservationLedger:
+    # Cash and positions each user can still commit to new orders, kept in
+    # the engine process so an order is accepted or rejected without touching
+    # the database. It is what User.balance / Holding hold once settlement has
+    # caught up, plus everything reserved or released since: reservations are
+    # taken here immediately and reach the database as `reserve` events of the
+    # sequenced command, and settled fills and releases are credited back when
+    # settlement reports them.
+    # An account is loaded on first use, after everything already queued for
+    # settlement has been written. Settlement commits and these reads share
+    # Django's sync thread and settled batches are reported before a load
+    # resumes, so a batch that lands during a load marks it dirty and the read
+    # is repeated. Accounts stay loaded for the life of the process, and are
+    # re-read when an order would be rejected (see reserve()).
+    def __init__(self, settlement):
+        self.settlement = settlement
+        self._accounts: Dict[int, Account] = {}
+        self._loads: Dict[int, asyncio.Future] = {}
+        self._dirty = set()
+        self.accepted = 0
+        self.rejected = 0
+
+    def stats(self) -> Dict:
+        return {'accounts': len(self._accounts), 'accepted': self.accepted, 'rejected': self.rejected}
+
+    async def account(self, user_id: int) -> Account:
+        account = self._accounts.get(user_id)
+        if account is not None:
+            return account
+
+        load = self._loads.get(user_id)
+        if load is None:
+            load = asyncio.ensure_future(self._load(user_id))
+            self._loads[user_id] = load
+            load.add_done_callback(lambda _: self._loads.pop(user_id, None))
+        return await load
+
+    async def _load(self, user_id: int) -> Account:
+        while True:
+            self._dirty.discard(user_id)
+            await self.settlement.wait_settled()
+            balance, positions = await database_sync_to_async(self._read)(user_id)
+            if user_id not in self._dirty:
+                break
+
+        account = Account(user_id, balance, positions)
+        self._accounts[user_id] = account
+        return account
+
+    def _read(self, user_id: int):
+        balance = User.objects.values_list('balance', flat=True).get(id=user_id)
+        positions = {}
+        for symbol, quantity in Holding.objects.filter(user_id=user_id).values_list('symbol', 'quantity'):
+            positions[symbol] = positions.get(symbol, 0) + quantity
+        return balance, positions
+
+    async def reserve_order(self, order: Dict) -> Optional[str]:
+        # `order` carries its price in ticks.
+        if order['order_type'] == 'BUY':
+            return await self.reserve(order['user_id'], order['symbol'], ticks=order['price'] * order['quantity'])
+        return await self.reserve(order['user_id'], order['symbol'], quantity=order['quantity'])
+
+    async def reserve(self, user_id: int, symbol: str, ticks: int = 0, quantity: int = 0) -> Optional[str]:
+        account = await self.account(user_id)
+        error = self._take(account, symbol, ticks, quantity)
+        if error is not None and not account.inflight:
+            # Deposits are committed outside the engine and only show up in
+            # the database. With nothing of this account on its way there, a
+            # fresh read is exact.
+            del self._accounts[user_id]
+            account = await self.account(user_id)
+            error = self._take(account, symbol, ticks, quantity)
+
+        if error is not None:
+            self.rejected += 1
+            return error
+        account.inflight += 1
+        self.accepted += 1
+        return None
+
+    def release_order(self, order: Dict):
+        if order['order_type'] == 'BUY':
+            self.release(order['user_id'], order['symbol'], ticks=order['price'] * order['quantity'])
+        else:
+            self.release(order['user_id'], order['symbol'], quantity=order['quantity'])
+
+    def release(self, user_id: int, symbol: str, ticks: int = 0, quantity: int = 0):
+        # Hands back a reservation whose `reserve` event will never be
+        # settled: its command failed, or settlement dropped the event.
+        account = self._accounts.get(user_id)
+        if account is not None and account.inflight:
+            account.inflight -= 1
+        self._credit(user_id, symbol, ticks, quantity)
+
+    def discarded(self, events: List[Dict]):
+        # Events settlement gave up on. Only reservations were taken here
+        # ahead of the database; anything else never reached the ledger.
+        for event in events:
+            if event['kind'] == 'reserve':
+                self.release(event['user_id'], event['symbol'], event['amount'], event['quantity'])
+
+    def _take(self, account: Account, symbol: str, ticks: int, quantity: int) -> Optional[str]:
+        if ticks:
+            amount = from_ticks(symbol, ticks)
+            if amount > account.cash:
+                return f'Insufficient balance. Required: {amount}'
+            account.cash -= amount
+        if quantity:
+            if account.positions.get(symbol, 0) < quantity:
+                return 'Insufficient holdings for sell order'
+            account.positions[symbol] -= quantity
+        return None
+
+    def settled(self, settled: List[Dict]):
+        # Credits what settlement just committed. Reservations were taken
+        # when the order came in; their events only mark them as written.
+        for result in settled:
+            event = result['event']
+            if event['kind'] == 'reserve':
+                self._touch(event['user_id'])
+                account = self._accounts.get(event['user_id'])
+                if account is not None and account.inflight:
+                    account.inflight -= 1
+                continue
+            if event['kind'] == 'release':
+                self._credit(event['user_id'], event['symbol'], event['amount'], event['quantity'])
+                continue
+            if event['kind'] != 'trade':
+                continue
+            refund = (event['buy_price'] - event['price']) * event['quantity']
+            self._credit(event['buyer_id'], event['symbol'], refund, event['quantity'])
+            self._credit(event['seller_id'], event['symbol'], event['total_amount'], 0)
+
+    def _credit(self, user_id: int, symbol: str, ticks: int, quantity: int):
+        self._touch(user_id)
+        account = self._accounts.get(user_id)
+        if account is None:
+            return
+        if ticks:
+            account.cash += from_ticks(symbol, ticks)
+        if quantity:
+            account.positions[symbol] = account.positions.get(symbol, 0) + quantity
+
+    def _touch(self, user_id: int):
+        if user_id in self._loads:
+            self._dirty.add(user_id)
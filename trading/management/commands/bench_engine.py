@@ -0,0 +1,292 @@
+import asyncio
+import json
+import os
+import platform
+import random
+import time
+import tracemalloc
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from trading.clock import format_ns, now_ns
+from trading.fanout import FanoutHub
+from trading.outbound import OutboundQueue
+from trading.matching_engine import matching_engine
+
+SCENARIOS = ('passive', 'aggressive', 'cancel')
+MID_PRICE = 100000
+USER_IDS = range(1, 101)
+
+
+class NullSettlement:
+    # Stands in for SettlementWorker so the run measures matching only.
+    def __init__(self):
+        self.fills = 0
+        self.releases = 0
+
+    async def submit(self, events: List[Dict]):
+        for event in events:
+            if event['kind'] == 'trade':
+                self.fills += 1
+            else:
+                self.releases += 1
+
+    async def wait_settled(self):
+        return
+
+    def stats(self) -> Dict:
+        return {'fills': self.fills, 'releases': self.releases}
+
+
+def rss_kb() -> Optional[int]:
+    # Current resident set size; unlike ru_maxrss it can be read before and
+    # after each scenario of a run. None where /proc is not available.
+    try:
+        with open('/proc/self/statm') as statm:
+            resident_pages = int(statm.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return resident_pages * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+def percentile(samples: List[int], fraction: float) -> float:
+    if not samples:
+        return 0.0
+    index = min(len(samples) - 1, int(fraction * len(samples)))
+    return samples[index] / 1000
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the matching engine with synthetic order flows and report throughput and latency as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenario', choices=SCENARIOS + ('all',), default='all')
+        parser.add_argument('--orders', type=int, default=100000, help='Commands per scenario')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--concurrency', type=int, default=1, help='Commands in flight at once')
+        parser.add_argument('--trace-memory', action='store_true',
+                            help='Report tracemalloc peak per scenario (much slower)')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+        parser.add_argument('--compare', help='Previous JSON report to compare against')
+        parser.add_argument('--fanout', default='',
+                            help='Comma-separated subscriber counts to time order book fan-out at, e.g. 100,1000,5000')
+
+    def handle(self, *args, **options):
+        if options['orders'] <= 0 or options['concurrency'] <= 0:
+            raise CommandError('--orders and --concurrency must be positive')
+        try:
+            fanout_sizes = [int(size) for size in options['fanout'].split(',') if size.strip()]
+        except ValueError:
+            raise CommandError('--fanout must be a comma-separated list of subscriber counts')
+        if any(size <= 0 for size in fanout_sizes):
+            raise CommandError('--fanout subscriber counts must be positive')
+
+        # Settlement and the journal are swapped out before the engine starts,
+        # so nothing is recovered from or written to disk or the database.
+        matching_engine.journal = None
+        matching_engine.ledger = None
+        matching_engine.settlement = NullSettlement()
+
+        scenarios = SCENARIOS if options['scenario'] == 'all' else (options['scenario'],)
+        report = {
+            'meta': {
+                'started_at': format_ns(now_ns()),
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'orders': options['orders'],
+                'seed': options['seed'],
+                'concurrency': options['concurrency'],
+                'sequencer_batch_size': settings.TRADING_SEQUENCER_BATCH_SIZE,
+            },
+            'scenarios': {}
+        }
+        for name in scenarios:
+            report['scenarios'][name] = asyncio.run(self.run_scenario(name, options))
+        if fanout_sizes:
+            report['fanout'] = {str(size): asyncio.run(self.run_fanout(size)) for size in fanout_sizes}
+
+        encoded = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as output:
+                output.write(encoded)
+        else:
+            self.stdout.write(encoded)
+
+        if options['compare']:
+            with open(options['compare'], encoding='utf-8') as baseline_file:
+                self.write_comparison(json.load(baseline_file), report)
+
+    async def run_scenario(self, name: str, options: Dict) -> Dict:
+        rng = random.Random(f"{options['seed']}-{name}")
+        symbol = f'BENCH-{name[:3].upper()}'
+        settlement = matching_engine.settlement
+        fills_before = settlement.fills
+
+        await matching_engine.start()
+        rss_before = rss_kb()
+        await self.seed_book(symbol, rng)
+
+        live_orders: List[int] = []
+        add_latencies: List[int] = []
+        cancel_latencies: List[int] = []
+
+        async def add(order: Dict):
+            started = time.perf_counter_ns()
+            result = await matching_engine.add_order(order)
+            add_latencies.append(time.perf_counter_ns() - started)
+            if result['order']['remaining_quantity']:
+                live_orders.append(result['order']['id'])
+
+        async def cancel(order_id: int, user_id: int):
+            started = time.perf_counter_ns()
+            await matching_engine.cancel_order(symbol, order_id, user_id)
+            cancel_latencies.append(time.perf_counter_ns() - started)
+
+        def next_command():
+            if name == 'cancel' and live_orders and rng.random() < 0.5:
+                order_id = live_orders.pop(rng.randrange(len(live_orders)))
+                order = matching_engine.get_order(symbol, order_id)
+                if order is not None:
+                    return cancel(order_id, order['user_id'])
+            return add(self.next_order(name, symbol, rng))
+
+        if options['trace_memory']:
+            tracemalloc.start()
+        started = time.perf_counter()
+        remaining = options['orders']
+        while remaining:
+            window = min(remaining, options['concurrency'])
+            await asyncio.gather(*(next_command() for _ in range(window)))
+            remaining -= window
+        elapsed = time.perf_counter() - started
+        traced_peak = None
+        if options['trace_memory']:
+            traced_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        add_latencies.sort()
+        cancel_latencies.sort()
+        book = matching_engine.get_book(symbol)
+        fills = settlement.fills - fills_before
+        result = {
+            'commands': options['orders'],
+            'adds': len(add_latencies),
+            'cancels': len(cancel_latencies),
+            'fills': fills,
+            'elapsed_s': round(elapsed, 4),
+            'orders_per_sec': round(options['orders'] / elapsed, 1),
+            'fills_per_sec': round(fills / elapsed, 1),
+            'add_latency_us': {
+                'p50': percentile(add_latencies, 0.5),
+                'p99': percentile(add_latencies, 0.99),
+                'p99.9': percentile(add_latencies, 0.999),
+                'max': percentile(add_latencies, 1.0),
+            },
+            'resting_orders': len(book.index),
+            'price_levels': len(book.bids) + len(book.asks),
+            'rss_before_kb': rss_before,
+            'rss_after_kb': rss_kb(),
+        }
+        if cancel_latencies:
+            result['cancel_latency_us'] = {
+                'p50': percentile(cancel_latencies, 0.5),
+                'p99': percentile(cancel_latencies, 0.99),
+                'p99.9': percentile(cancel_latencies, 0.999),
+            }
+        if traced_peak is not None:
+            result['traced_peak_bytes'] = traced_peak
+        return result
+
+    async def run_fanout(self, subscribers: int, rounds: int = 200) -> Dict:
+        # Publishes a top-of-book delta to `subscribers` outbound queues whose
+        # sockets only count frames, so the figures are the hub's own cost.
+        hub = FanoutHub()
+        received = [0]
+
+        async def send(frame: str):
+            received[0] += 1
+
+        outbounds = [
+            OutboundQueue(send, lambda: None, max_pending=rounds + 1, max_lag_seconds=3600)
+            for _ in range(subscribers)
+        ]
+        for index, outbound in enumerate(outbounds):
+            hub.subscribe('BENCH', f'sink-{index}', outbound)
+            outbound.start()
+        frame = json.dumps({
+            'type': 'orderbook_delta',
+            'data': {
+                'symbol': 'BENCH',
+                'prev_seq': 1,
+                'seq': 2,
+                'changes': [{'side': 'BUY', 'price': 1000.05, 'quantity': 120, 'orders': 3}] * 4,
+                'timestamp': format_ns(now_ns())
+            }
+        })
+
+        samples: List[int] = []
+        for _ in range(rounds):
+            started = time.perf_counter_ns()
+            hub.publish('BENCH', frame)
+            samples.append(time.perf_counter_ns() - started)
+            # Let the writers drain before the next frame, as a live loop would.
+            await asyncio.sleep(0)
+        for outbound in outbounds:
+            outbound.close()
+        samples.sort()
+        return {
+            'subscribers': subscribers,
+            'frames_delivered': received[0],
+            'publish_us': {
+                'p50': percentile(samples, 0.5),
+                'p99': percentile(samples, 0.99),
+            },
+            'per_subscriber_us': round(percentile(samples, 0.5) / subscribers, 4),
+        }
+
+    async def seed_book(self, symbol: str, rng: random.Random):
+        # A resting ladder on both sides so the first aggressive orders
+        # have something to trade against.
+        for offset in range(1, 51):
+            for order_type, price in (('BUY', MID_PRICE - offset), ('SELL', MID_PRICE + offset)):
+                await matching_engine.add_order(self.make_order(symbol, rng, order_type, price, rng.randint(1, 20)))
+
+    def next_order(self, scenario: str, symbol: str, rng: random.Random) -> Dict:
+        order_type = rng.choice(('BUY', 'SELL'))
+        direction = 1 if order_type == 'BUY' else -1
+        if scenario == 'aggressive' and rng.random() < 0.3:
+            # Crosses the spread and sweeps several levels.
+            price = MID_PRICE + direction * rng.randint(5, 20)
+            return self.make_order(symbol, rng, order_type, price, rng.randint(20, 200))
+        price = MID_PRICE - direction * rng.randint(1, 50)
+        return self.make_order(symbol, rng, order_type, price, rng.randint(1, 20))
+
+    def make_order(self, symbol: str, rng: random.Random, order_type: str, price: int, quantity: int) -> Dict:
+        return {
+            'user_id': rng.choice(USER_IDS),
+            'user_email': 'bench@example.com',
+            'symbol': symbol,
+            'order_type': order_type,
+            'price': price,
+            'quantity': quantity
+        }
+
+    def write_comparison(self, baseline: Dict, report: Dict):
+        rows = (
+            ('orders_per_sec', lambda result: result['orders_per_sec']),
+            ('fills_per_sec', lambda result: result['fills_per_sec']),
+            ('add p50 us', lambda result: result['add_latency_us']['p50']),
+            ('add p99 us', lambda result: result['add_latency_us']['p99']),
+            ('add p99.9 us', lambda result: result['add_latency_us']['p99.9']),
+        )
+        for name, result in report['scenarios'].items():
+            previous = baseline.get('scenarios', {}).get(name)
+            if previous is None:
+                continue
+            self.stderr.write(f'{name}:')
+            for label, metric in rows:
+                old, new = metric(previous), metric(result)
+                change = f'{(new - old) / old * 100:+.1f}%' if old else 'n/a'
+                self.stderr.write(f'  {label:<15} {old:>12} -> {new:>12}  {change}')
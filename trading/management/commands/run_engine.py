@@ -0,0 +1,29 @@
+import asyncio
+
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from trading.engine_server import EngineServer
+
+
+class Command(BaseCommand):
+    help = 'Run the matching engine for one shard of the symbols and serve ASGI workers over the channel layer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shard', type=int, default=0,
+                            help='Shard to serve, from 0 to TRADING_ENGINE_SHARDS - 1')
+
+    def handle(self, *args, **options):
+        channel_layer = get_channel_layer()
+        if isinstance(channel_layer, InMemoryChannelLayer):
+            raise CommandError('The engine process needs a channel layer shared with the workers; set REDIS_URL')
+        shard = options['shard']
+        if not 0 <= shard < settings.TRADING_ENGINE_SHARDS:
+            raise CommandError(f'--shard must be between 0 and {settings.TRADING_ENGINE_SHARDS - 1}')
+
+        self.stdout.write(f'Engine shard {shard} of {settings.TRADING_ENGINE_SHARDS} started, waiting for workers')
+        try:
+            asyncio.run(EngineServer(channel_layer, [shard]).serve())
+        except KeyboardInterrupt:
+            pass
@@ -1,333 +1,777 @@
 import asyncio
 import logging
 from typing import List, Dict, Any
-from decimal import Decimal
-from django.db import transaction
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from channels.layers import get_channel_layer
 import json
-from datetime import datetime
-import uuid
-from collections import defaultdict
-from asgiref.sync import sync_to_async
-
-from accounts.models import Holding
+import re
+import time
+from decimal import Decimal
+from channels.db import database_sync_to_async
+
+from .candles import CandleAggregator
+from .clock import format_ns, now_ns
+from .fanout import FanoutHub
+from .journal import EngineJournal
+from .ledger import ReservationLedger
+from .models import SettlementCheckpoint
+from .order_book import Order, OrderBook
+from .outbound import OutboundQueue
+from .portfolio import Portfolio, portfolio_cache
+from .sequencer import BookSequencer
+from .settlement import SettlementWorker
+from .ticks import from_ticks, ticks_to_float
 
 User = get_user_model()
 logger = logging.getLogger(__name__)
 
+DEFAULT_SYMBOL = 'RELIANCE'
+ORDERBOOK_DEPTH = 5
+SYMBOL_PATTERN = re.compile(r'^[A-Z0-9][A-Z0-9._-]{0,9}$')
+
+
+def normalize_symbol(symbol) -> str:
+    if symbol is None:
+        return DEFAULT_SYMBOL
+    if not isinstance(symbol, str):
+        raise ValueError('Symbol must be a string')
+    symbol = symbol.strip().upper()
+    if not SYMBOL_PATTERN.match(symbol):
+        raise ValueError(f'Invalid symbol: {symbol}')
+    return symbol
+
+def user_group(user_id: int) -> str:
+    return f'user_{user_id}'
+
+def candle_topic(symbol: str) -> str:
+    # Fan-out topic (and outbound conflation key) of a symbol's candles.
+    return f'candles:{symbol}'
+
 class OrderMatchingEngine:
     _instance = None
 
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super(OrderMatchingEngine, cls).__new__(cls)
-            cls._instance.buy_orders: List[Dict[str, Any]] = []
-            cls._instance.sell_orders: List[Dict[str, Any]] = []
+            cls._instance.books: Dict[str, OrderBook] = {}
+            cls._instance.sequencers: Dict[str, BookSequencer] = {}
             cls._instance.connected_trading_consumers = set()
-            cls._instance._periodic_task = None
-            cls._instance._is_running = False
-            cls._instance.broadcast_interval = 1
+            cls._instance.orderbook_hub = FanoutHub()
+            cls._instance.publish_interval = settings.TRADING_ORDERBOOK_PUBLISH_INTERVAL_MS / 1000
+            cls._instance._publish_tasks: Dict[str, asyncio.Task] = {}
+            cls._instance._published_at: Dict[str, float] = {}
+            cls._instance.candles = CandleAggregator(history=settings.TRADING_CANDLE_HISTORY)
+            cls._instance.settlement = SettlementWorker(
+                cls._instance._on_trades_settled,
+                max_queue_size=settings.TRADING_SETTLEMENT_QUEUE_SIZE,
+                batch_size=settings.TRADING_SETTLEMENT_BATCH_SIZE,
+                on_dropped=cls._instance._on_events_dropped
+            )
+            cls._instance.ledger = None
+            if settings.TRADING_RESERVATION_LEDGER:
+                cls._instance.ledger = ReservationLedger(cls._instance.settlement)
+            cls._instance.journal = None
+            if settings.TRADING_JOURNAL_DIR:
+                cls._instance.journal = EngineJournal(
+                    settings.TRADING_JOURNAL_DIR,
+                    fsync=settings.TRADING_JOURNAL_FSYNC
+                )
+            cls._instance._snapshot_seqs: Dict[str, int] = {}
+            cls._instance._snapshot_tasks: Dict[str, asyncio.Task] = {}
+            cls._instance._recovery_task = None
+            # Set by a sharded engine process: which journaled books it
+            # recovers, and who hears about users whose portfolios it settled.
+            cls._instance.owns_symbol = lambda symbol: True
+            cls._instance.settled_listener = None
         return cls._instance
 
+    async def start(self):
+        if self._recovery_task is None:
+            self._recovery_task = asyncio.create_task(self._recover())
+        await self._recovery_task
+
+    async def _recover(self):
+        if self.journal is None:
+            return
+
+        checkpoints = await database_sync_to_async(
+            lambda: dict(SettlementCheckpoint.objects.values_list('symbol', 'seq'))
+        )()
+        for symbol in self.journal.symbols():
+            if not self.owns_symbol(symbol):
+                continue
+            snapshot_seq, state, entries = self.journal.load(symbol)
+            book = self.get_book(symbol)
+            if state is not None:
+                self._restore_book(book, state)
+
+            sequencer = self._get_sequencer(symbol)
+            sequencer.last_seq = sequencer.applied_seq = snapshot_seq
+            events = sequencer.replay(entries)
+            self._fold_candles(symbol, events)
+            self._snapshot_seqs[symbol] = snapshot_seq
+            self.journal.rotate(symbol, sequencer.last_seq + 1)
+
+            # Fills up to the checkpoint were committed before the restart.
+            checkpoint = checkpoints.get(symbol, 0)
+            unsettled = [event for event in events if event['seq'] > checkpoint]
+            await self.settlement.submit(unsettled)
+            logger.info(
+                f"Recovered {symbol} at #{sequencer.last_seq} from snapshot #{snapshot_seq}, "
+                f"{len(book.index)} resting orders, {len(unsettled)} events to settle"
+            )
+
     def add_trading_consumer(self, channel_name):
         self.connected_trading_consumers.add(channel_name)
-        consumer_count = len(self.connected_trading_consumers)
-        
-        if consumer_count == 1 and not self._is_running:
-            self._start_periodic_broadcasting()
 
     def remove_trading_consumer(self, channel_name):
         self.connected_trading_consumers.discard(channel_name)
-        consumer_count = len(self.connected_trading_consumers)
-        
-        if consumer_count == 0 and self._is_running:
-            self._stop_periodic_broadcasting()
-
-    def _start_periodic_broadcasting(self):
-        if self._periodic_task is not None and not self._periodic_task.done():
+        self.orderbook_hub.unsubscribe_all(channel_name)
+
+    def subscribe_orderbook(self, channel_name, symbol, outbound: OutboundQueue):
+        # The snapshot is queued under the same key as the deltas that follow
+        # it, so a connection that falls behind is handed a newer snapshot.
+        # Candles follow the same pattern under their own topic.
+        outbound.put(self.get_orderbook_snapshot(symbol), symbol)
+        outbound.put(self.get_candle_snapshot(symbol), candle_topic(symbol))
+        self.orderbook_hub.subscribe(symbol, channel_name, outbound)
+        self.orderbook_hub.subscribe(candle_topic(symbol), channel_name, outbound)
+
+    def get_orderbook_snapshot(self, symbol) -> str:
+        # Publish whatever changed since the last delta to the existing
+        # subscribers first, so the snapshot sits exactly on the delta stream.
+        book = self.get_book(symbol)
+        self._publish_orderbook_delta(book)
+        return book.cached_snapshot(self._encode_orderbook)
+
+    def get_candle_snapshot(self, symbol) -> str:
+        self._publish_candles(symbol)
+        return self._encode_candles(symbol)
+
+    def unsubscribe_orderbook(self, channel_name, symbol):
+        self.orderbook_hub.unsubscribe(symbol, channel_name)
+        self.orderbook_hub.unsubscribe(candle_topic(symbol), channel_name)
+
+    def get_book(self, symbol: str) -> OrderBook:
+        book = self.books.get(symbol)
+        if book is None:
+            book = OrderBook(symbol)
+            self.books[symbol] = book
+        return book
+
+    def _schedule_orderbook_publish(self, symbol: str):
+        if not self.orderbook_hub.subscriber_count(symbol):
             return
-        
-        self._is_running = True
-        self._periodic_task = asyncio.create_task(self._periodic_orderbook_broadcast())
-
-    def _stop_periodic_broadcasting(self):
-        self._is_running = False
-        if self._periodic_task and not self._periodic_task.done():
-            self._periodic_task.cancel()
-
-    async def _periodic_orderbook_broadcast(self):
+        task = self._publish_tasks.get(symbol)
+        if task is not None and not task.done():
+            return
+        self._publish_tasks[symbol] = asyncio.create_task(self._publish_orderbook(symbol))
+
+    async def _publish_orderbook(self, symbol: str):
+        # At most one delta per `publish_interval`; changes that land while
+        # this waits go out together in the next one. The task ends as soon as
+        # the book and its candles have nothing new, and the next change
+        # starts another.
+        book = self.books[symbol]
         try:
-            while self._is_running:
-                if self.connected_trading_consumers:
-                    await self._broadcast_orderbook()
-                else:
-                    break
-                
-                await asyncio.sleep(self.broadcast_interval)
-        except asyncio.CancelledError:
-            logger.info("Periodic orderbook broadcasting cancelled")
+            while True:
+                delay = self._published_at.get(symbol, 0) + self.publish_interval - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                published = self._publish_orderbook_delta(book)
+                if not self._publish_candles(symbol) and not published:
+                    return
+                self._published_at[symbol] = time.monotonic()
         except Exception as e:
-            logger.error(f"Error in periodic orderbook broadcasting: {e}", exc_info=True)
-        finally:
-            self._is_running = False
-
-    async def _broadcast_orderbook(self):
-        if not self.connected_trading_consumers:
-            return
-
-        channel_layer = get_channel_layer()
-        orderbook_data = self.get_orderbook()
-        message = json.dumps({'type': 'orderbook', 'data': orderbook_data})
-
-        tasks = []
-        for channel_name in list(self.connected_trading_consumers):
-            task = channel_layer.send(channel_name, {
-                "type": "orderbook.update",
-                "message": message
-            })
-            tasks.append(task)
-
-        if tasks:
-            await asyncio.gather(*tasks, return_exceptions=True)
+            logger.error(f"Error publishing {symbol} orderbook: {e}", exc_info=True)
+
+    def _publish_orderbook_delta(self, book: OrderBook) -> bool:
+        delta = self._take_orderbook_delta(book)
+        if delta is None:
+            return False
+        self.orderbook_hub.publish(
+            book.symbol, delta,
+            supersede=lambda: book.cached_snapshot(self._encode_orderbook)
+        )
+        return True
+
+    def _publish_candles(self, symbol: str) -> bool:
+        changes = self.candles.take_changes(symbol)
+        if changes is None:
+            return False
+        self.orderbook_hub.publish(
+            candle_topic(symbol),
+            json.dumps({'type': 'candle_update', 'data': {'symbol': symbol, 'candles': changes}}),
+            supersede=lambda: self._encode_candles(symbol)
+        )
+        return True
+
+    def _encode_candles(self, symbol: str) -> str:
+        return self.candles.cached_history(
+            symbol, lambda candles: json.dumps({'type': 'candles', 'data': {'symbol': symbol, 'candles': candles}})
+        )
+
+    def _take_orderbook_delta(self, book: OrderBook) -> str:
+        delta = book.take_delta(ORDERBOOK_DEPTH)
+        if delta is None:
+            return None
+        prev_seq, seq, changes = delta
+        return json.dumps({
+            'type': 'orderbook_delta',
+            'data': {
+                'symbol': book.symbol,
+                'prev_seq': prev_seq,
+                'seq': seq,
+                'changes': self._priced_levels(book.symbol, changes),
+                'timestamp': format_ns(now_ns())
+            }
+        })
 
     async def add_order(self, order_data: Dict) -> Dict:
-        order = {
-            'id': str(uuid.uuid4()),
+        order = self._order_payload(order_data)
+        await self.start()
+        error = await self._reserve(order)
+        if error is not None:
+            return {'success': False, 'error': error}
+        try:
+            return await self._get_sequencer(order['symbol']).submit('add', order)
+        except Exception:
+            self._unreserve(order)
+            raise
+
+    async def add_orders(self, orders_data: List[Dict]) -> List[Any]:
+        # Everything is reserved, then enqueued before any result is awaited,
+        # so a basket lands in as few sequencer batches as possible. Rejected
+        # orders come back as a failed result, failed ones as their exception.
+        orders = [self._order_payload(order_data) for order_data in orders_data]
+        await self.start()
+        results: List[Any] = [None] * len(orders)
+        submitted = []
+        for index, order in enumerate(orders):
+            error = await self._reserve(order)
+            if error is not None:
+                results[index] = {'success': False, 'error': error}
+            else:
+                submitted.append(index)
+        futures = [self._get_sequencer(orders[index]['symbol']).submit('add', orders[index]) for index in submitted]
+        for index, result in zip(submitted, await asyncio.gather(*futures, return_exceptions=True)):
+            if isinstance(result, Exception):
+                self._unreserve(orders[index])
+            results[index] = result
+        return results
+
+    async def _reserve(self, order: Dict):
+        # With the ledger on, the engine takes the funds or holdings an order
+        # needs itself; otherwise the caller reserved them in the database.
+        if self.ledger is None:
+            return None
+        error = await self.ledger.reserve_order(order)
+        if error is None:
+            order['reserve'] = True
+        return error
+
+    def _unreserve(self, order: Dict):
+        # The order's command failed, so no `reserve` event will settle it.
+        if order.get('reserve'):
+            self.ledger.release_order(order)
+
+    def _order_payload(self, order_data: Dict) -> Dict:
+        # `price` is already in ticks here; see trading.ticks. The order id is
+        # assigned when the command is applied.
+        return {
             'user_id': order_data['user_id'],
             'user_email': order_data.get('user_email', 'N/A'),
-            'symbol': order_data['symbol'],
+            'symbol': normalize_symbol(order_data['symbol']),
             'order_type': order_data['order_type'].upper(),
-            'price': float(order_data['price']),
+            'price': int(order_data['price']),
             'quantity': int(order_data['quantity']),
-            'filled_quantity': 0,
-            'remaining_quantity': int(order_data['quantity']),
-            'status': 'PENDING',
-            'created_at': datetime.now().isoformat()+'Z'
+            'created_at': now_ns()
         }
 
-        if order['order_type'] == 'BUY':
-            self.buy_orders.append(order)
-            self.buy_orders.sort(key=lambda x: (-x['price'], x['created_at']))
-        else:
-            self.sell_orders.append(order)
-            self.sell_orders.sort(key=lambda x: (x['price'], x['created_at']))
+    async def cancel_order(self, symbol: str, order_id: int, user_id: int) -> Dict:
+        await self.start()
+        if symbol not in self.books:
+            return {'success': False, 'error': 'Order not found'}
+        return await self._get_sequencer(symbol).submit('cancel', {
+            'order_id': order_id,
+            'user_id': user_id
+        })
+
+    async def amend_order(self, symbol: str, order_id: int, user_id: int, price=None, quantity=None,
+                          reserved_extra: int = 0) -> Dict:
+        await self.start()
+        reserve = False
+        if self.ledger is not None:
+            # The extra cash a higher buy price needs is worked out here from
+            # the resting order; the sequenced amendment settles any difference.
+            reserved_extra = 0
+            order = self.get_order(symbol, order_id)
+            if order is not None and order['user_id'] == user_id and order['order_type'] == 'BUY' and price is not None:
+                new_quantity = quantity if quantity is not None else order['remaining_quantity']
+                extra = price * new_quantity - order['price'] * order['remaining_quantity']
+                if extra > 0:
+                    error = await self.ledger.reserve(user_id, symbol, ticks=extra)
+                    if error is not None:
+                        return {'success': False, 'error': error}
+                    reserved_extra = extra
+                    reserve = True
+        if symbol not in self.books and not reserved_extra:
+            return {'success': False, 'error': 'Order not found'}
+        try:
+            return await self._get_sequencer(symbol).submit('amend', {
+                'order_id': order_id,
+                'user_id': user_id,
+                'price': price,
+                'quantity': quantity,
+                'reserved_extra': reserved_extra,
+                'reserve': reserve
+            })
+        except Exception:
+            if reserve:
+                self.ledger.release(user_id, symbol, ticks=reserved_extra)
+            raise
+
+    def get_order(self, symbol: str, order_id: int) -> Dict:
+        book = self.books.get(symbol)
+        order = book.get(order_id) if book is not None else None
+        return order.to_dict() if order is not None else None
+
+    def _get_sequencer(self, symbol: str) -> BookSequencer:
+        sequencer = self.sequencers.get(symbol)
+        if sequencer is None:
+            book = self.get_book(symbol)
+            sequencer = BookSequencer(
+                symbol,
+                lambda kind, payload, seq, events: self._apply_command(book, kind, payload, seq, events),
+                self._on_batch_applied,
+                batch_size=settings.TRADING_SEQUENCER_BATCH_SIZE,
+                journal=self.journal
+            )
+            self.sequencers[symbol] = sequencer
+        return sequencer
+
+    async def _on_batch_applied(self, symbol: str, events: List[Dict]):
+        self._fold_candles(symbol, events)
+        self._schedule_orderbook_publish(symbol)
+        await self.settlement.submit(events)
+        if self.journal is not None:
+            self._maybe_snapshot(symbol)
+
+    def _fold_candles(self, symbol: str, events: List[Dict]):
+        for event in events:
+            if event['kind'] == 'trade':
+                self.candles.add_trade(symbol, event['price'], event['quantity'], event['created_at'])
+
+    def _maybe_snapshot(self, symbol: str):
+        sequencer = self.sequencers[symbol]
+        seq = sequencer.applied_seq
+        if seq - self._snapshot_seqs.get(symbol, 0) < settings.TRADING_SNAPSHOT_INTERVAL:
+            return
+        task = self._snapshot_tasks.get(symbol)
+        if task is not None and not task.done():
+            return
+
+        # The sequencer is waiting on this call, so the book is exactly the
+        # state after `seq`. Copy it now and write it out in the background.
+        state = self._book_state(self.books[symbol])
+        self.journal.rotate(symbol, seq + 1)
+        self._snapshot_seqs[symbol] = seq
+        self._snapshot_tasks[symbol] = asyncio.create_task(self._write_snapshot(symbol, seq, state))
+
+    async def _write_snapshot(self, symbol: str, seq: int, state: Dict):
+        try:
+            # Replay starts after the snapshot, so every fill it covers has to
+            # be settled before the older journal segments can go.
+            await self.settlement.wait_settled()
+            await asyncio.to_thread(self.journal.write_snapshot, symbol, seq, state)
+        except Exception as e:
+            logger.error(f"Error writing {symbol} snapshot at #{seq}: {e}", exc_info=True)
+
+    def _book_state(self, book: OrderBook) -> Dict:
+        orders = [order.to_dict() for order in book.bids.orders()]
+        orders.extend(order.to_dict() for order in book.asks.orders())
+        return {'version': book.version, 'trade_seq': book.trade_seq, 'orders': orders}
+
+    def _restore_book(self, book: OrderBook, state: Dict):
+        for order in state['orders']:
+            book.add(Order(**order))
+        book.version = state['version']
+        book.trade_seq = state.get('trade_seq', 0)
+
+    def _apply_command(self, book: OrderBook, kind: str, payload: Dict, seq: int, events: List[Dict]) -> Dict:
+        if kind == 'add':
+            fields = dict(payload)
+            reserve = fields.pop('reserve', False)
+            order = Order(id=seq, **fields)
+            if not reserve:
+                return self._add_order(book, order, events)
+            if order.order_type == 'BUY':
+                reserve_event = self._reserve_event(
+                    order.id, order.user_id, order.symbol, order.price, amount=self._reserved_amount(order)
+                )
+            else:
+                reserve_event = self._reserve_event(
+                    order.id, order.user_id, order.symbol, order.price, quantity=order.quantity
+                )
+            # Recorded only once the order is in, ahead of its fills; if the
+            # command fails the caller hands the reservation back instead.
+            first_event = len(events)
+            result = self._add_order(book, order, events)
+            events.insert(first_event, reserve_event)
+            return result
+        if kind == 'cancel':
+            return self._cancel_order(book, payload, events)
+        if kind == 'amend':
+            return self._amend_order(book, payload, events)
+        raise ValueError(f'Unknown command: {kind}')
+
+    def _add_order(self, book: OrderBook, order: Order, events: List[Dict]) -> Dict:
+        book.add(order)
+
+        matches = self._match_orders(book, events)
 
-        matches = await self._match_orders()
-        
         return {
-            'order': order,
+            'success': True,
+            'order': order.to_dict(),
             'matches': matches
         }
 
-    async def _match_orders(self) -> List[Dict]:
+    def _reserved_amount(self, order: Order) -> int:
+        return order.price * order.remaining_quantity
+
+    def _release_event(self, order_id: int, user_id: int, symbol: str, price: int, amount=0, quantity=0) -> Dict:
+        return {
+            'kind': 'release',
+            'order_id': order_id,
+            'user_id': user_id,
+            'symbol': symbol,
+            'price': price,
+            'amount': amount,
+            'quantity': quantity
+        }
+
+    def _reserve_event(self, order_id: int, user_id: int, symbol: str, price: int, amount=0, quantity=0) -> Dict:
+        # A ledger reservation, written to the database by settlement ahead of
+        # the command's fills.
+        event = self._release_event(order_id, user_id, symbol, price, amount, quantity)
+        event['kind'] = 'reserve'
+        return event
+
+    def _cancel_order(self, book: OrderBook, payload: Dict, events: List[Dict]) -> Dict:
+        order = book.get(payload['order_id'])
+        if order is None or order.user_id != payload['user_id']:
+            return {'success': False, 'error': 'Order not found'}
+
+        book.remove(order.id)
+        order.status = 'CANCELLED'
+
+        if order.order_type == 'BUY':
+            amount, quantity = self._reserved_amount(order), 0
+        else:
+            amount, quantity = 0, order.remaining_quantity
+        events.append(self._release_event(order.id, order.user_id, order.symbol, order.price, amount, quantity))
+        events.append(self._closed_event(order))
+
+        return {'success': True, 'order': order.to_dict()}
+
+    def _amend_order(self, book: OrderBook, payload: Dict, events: List[Dict]) -> Dict:
+        reserved_extra = payload['reserved_extra']
+        first_event = len(events)
+        result = self._apply_amendment(book, payload, events)
+        if payload.get('reserve') and reserved_extra > 0:
+            events.insert(first_event, self._reserve_event(
+                payload['order_id'], payload['user_id'], book.symbol, payload['price'], amount=reserved_extra
+            ))
+
+        if not result['success'] and reserved_extra > 0:
+            events.append(self._release_event(
+                payload['order_id'], payload['user_id'], book.symbol, payload['price'], amount=reserved_extra
+            ))
+
+        return result
+
+    def _apply_amendment(self, book: OrderBook, payload: Dict, events: List[Dict]) -> Dict:
+        order = book.get(payload['order_id'])
+        if order is None or order.user_id != payload['user_id']:
+            return {'success': False, 'error': 'Order not found'}
+
+        price = payload['price']
+        quantity = payload['quantity']
+        new_price = int(price) if price is not None else order.price
+        new_quantity = int(quantity) if quantity is not None else order.remaining_quantity
+        if new_price <= 0 or new_quantity <= 0:
+            return {'success': False, 'error': 'Price and quantity must be positive'}
+        if new_quantity > order.remaining_quantity:
+            return {'success': False, 'error': 'Quantity can only be reduced'}
+        if new_price == order.price and new_quantity == order.remaining_quantity:
+            return {'success': False, 'error': 'Nothing to amend'}
+
+        release = None
+        if order.order_type == 'BUY':
+            available = self._reserved_amount(order) + payload['reserved_extra']
+            required = new_price * new_quantity
+            if required > available:
+                shortfall = from_ticks(book.symbol, required - available)
+                return {'success': False, 'error': f'Insufficient balance. Required: {shortfall}'}
+            if available > required:
+                release = self._release_event(
+                    order.id, order.user_id, order.symbol, order.price, amount=available - required
+                )
+        elif new_quantity < order.remaining_quantity:
+            release = self._release_event(
+                order.id, order.user_id, order.symbol, order.price,
+                quantity=order.remaining_quantity - new_quantity
+            )
+
+        if release is not None:
+            events.append(release)
+        if new_price == order.price:
+            # A pure size reduction keeps the order's place in the queue.
+            book.reduce(order.id, new_quantity)
+            return {'success': True, 'order': order.to_dict(), 'matches': []}
+
+        book.remove(order.id)
+        order.price = new_price
+        order.quantity -= order.remaining_quantity - new_quantity
+        order.remaining_quantity = new_quantity
+        book.add(order)
+
+        matches = self._match_orders(book, events)
+        return {'success': True, 'order': order.to_dict(), 'matches': matches}
+
+    def _match_orders(self, book: OrderBook, events: List[Dict]) -> List[Dict]:
+        # Trades are returned and, with the orders they close, added to
+        # `events`.
         matches = []
         
-        while self.buy_orders and self.sell_orders:
-            best_buy = self.buy_orders[0]
-            best_sell = self.sell_orders[0]
-            
-            if best_buy['price'] < best_sell['price']:
-                break
+        bids = book.bids
+        asks = book.asks
 
-            trade_quantity = min(best_buy['remaining_quantity'], best_sell['remaining_quantity'])
-            trade_price = best_sell['price']
+        while bids and asks:
+            buy_level = bids.best_level()
+            sell_level = asks.best_level()
             
-            try:
-                trade_result = await self._execute_trade_in_db(
-                    best_buy, best_sell, trade_quantity, trade_price
-                )
-                
-                if not trade_result['success']:
-                    break
-                
-                buyer = trade_result['buyer']
-                seller = trade_result['seller']
-                total_amount = trade_result['total_amount']
-
-                best_buy['filled_quantity'] += trade_quantity
-                best_buy['remaining_quantity'] -= trade_quantity
-                best_sell['filled_quantity'] += trade_quantity
-                best_sell['remaining_quantity'] -= trade_quantity
-
-                if best_buy['remaining_quantity'] == 0:
-                    best_buy['status'] = 'FILLED'
-                    self.buy_orders.pop(0)
-                else:
-                    best_buy['status'] = 'PARTIALLY_FILLED'
-
-                if best_sell['remaining_quantity'] == 0:
-                    best_sell['status'] = 'FILLED'
-                    self.sell_orders.pop(0)
-                else:
-                    best_sell['status'] = 'PARTIALLY_FILLED'
-
-                trade_info = {
-                    'trade_id': str(uuid.uuid4()),
-                    'symbol': best_buy['symbol'],
-                    'price': trade_price,
-                    'quantity': trade_quantity,
-                    'total_amount': float(total_amount),
-                    'buyer_id': best_buy['user_id'],
-                    'seller_id': best_sell['user_id'],
-                    'buyer_email': best_buy['user_email'],
-                    'seller_email': best_sell['user_email'],
-                    'created_at': datetime.now().isoformat()+'Z'
-                }
-                matches.append(trade_info)
-
-                asyncio.create_task(self._notify_user_update(buyer, 'BUY', trade_info))
-                asyncio.create_task(self._notify_user_update(seller, 'SELL', trade_info))
-
-            except Exception as e:
+            if buy_level.price < sell_level.price:
                 break
 
+            best_buy = buy_level.peek()
+            best_sell = sell_level.peek()
+            trade_quantity = min(best_buy.remaining_quantity, best_sell.remaining_quantity)
+            trade_price = best_sell.price
+
+            bids.fill(buy_level, best_buy, trade_quantity)
+            asks.fill(sell_level, best_sell, trade_quantity)
+
+            trade_info = {
+                'kind': 'trade',
+                'trade_id': book.next_trade_id(),
+                'symbol': best_buy.symbol,
+                'price': trade_price,
+                'quantity': trade_quantity,
+                'total_amount': trade_price * trade_quantity,
+                'buy_price': best_buy.price,
+                'buyer_id': best_buy.user_id,
+                'seller_id': best_sell.user_id,
+                'buy_order_id': best_buy.id,
+                'sell_order_id': best_sell.id,
+                'buyer_email': best_buy.user_email,
+                'seller_email': best_sell.user_email,
+                'created_at': now_ns()
+            }
+            matches.append(trade_info)
+            events.append(trade_info)
+
+            if best_buy.remaining_quantity == 0:
+                best_buy.status = 'FILLED'
+                bids.pop_best_order()
+                events.append(self._closed_event(best_buy))
+            else:
+                best_buy.status = 'PARTIALLY_FILLED'
+
+            if best_sell.remaining_quantity == 0:
+                best_sell.status = 'FILLED'
+                asks.pop_best_order()
+                events.append(self._closed_event(best_sell))
+            else:
+                best_sell.status = 'PARTIALLY_FILLED'
+
         return matches
 
-    @sync_to_async
-    def _execute_trade_in_db(self, best_buy, best_sell, trade_quantity, trade_price):
-        try:
-            with transaction.atomic():
-                buyer = User.objects.select_for_update().get(id=best_buy['user_id'])
-                seller = User.objects.select_for_update().get(id=best_sell['user_id'])
-                
-                total_amount = Decimal(str(trade_price)) * Decimal(trade_quantity)
-
-                buyer_paid_price = Decimal(str(best_buy['price']))
-                buyer_paid_amount = buyer_paid_price * Decimal(trade_quantity)
-                actual_cost = total_amount
-                
-                if buyer_paid_amount > actual_cost:
-                    refund_amount = buyer_paid_amount - actual_cost
-                    buyer.balance += refund_amount
-                    buyer.save()
-
-                holding, created = Holding.objects.get_or_create(
-                    user=buyer, 
-                    symbol=best_buy['symbol'],
-                    defaults={
-                        'quantity': 0,
-                        'price': Decimal(str(trade_price)),
-                        'total': Decimal('0.0')
-                    }
-                )
-                
-                if not created:
-                    new_quantity = holding.quantity + trade_quantity
-                    new_total = holding.total + total_amount
-                    holding.price = new_total / new_quantity if new_quantity > 0 else Decimal(str(trade_price))
-                    holding.quantity = new_quantity
-                    holding.total = new_total
-                else:
-                    holding.quantity = trade_quantity
-                    holding.price = Decimal(str(trade_price))
-                    holding.total = total_amount
-                
-                holding.save()
-
-                seller.balance += total_amount
-                seller.save()
-                
-                return {
-                    'success': True,
-                    'buyer': buyer,
-                    'seller': seller,
-                    'total_amount': total_amount
-                }
-
-        except User.DoesNotExist as e:
-            return {'success': False, 'error': 'User not found'}
-        except Exception as e:
-            return {'success': False, 'error': str(e)}
+    def _closed_event(self, order: Order) -> Dict:
+        # Recorded in the order history by settlement.
+        event = order.to_dict()
+        del event['id'], event['user_email'], event['remaining_quantity']
+        event.update(kind='order', order_id=order.id, closed_at=now_ns())
+        return event
+
+    def _on_events_dropped(self, events: List[Dict]):
+        if self.ledger is not None:
+            self.ledger.discarded(events)
+
+    async def _on_trades_settled(self, settled: List[Dict]):
+        # Settlement hands back the rows it committed, so the cached
+        # portfolios are refreshed from them without another query. The ledger
+        # goes first, before anything here yields; see ReservationLedger.
+        if self.ledger is not None:
+            self.ledger.settled(settled)
+        for result in settled:
+            event = result['event']
+            if event['kind'] in ('release', 'reserve'):
+                portfolio_cache.set_balance(result['user'].id, result['user'].balance)
+                if event['quantity']:
+                    portfolio_cache.set_holding(result['user'].id, event['symbol'], result['holding'])
+            elif event['kind'] == 'trade':
+                portfolio_cache.set_balance(result['buyer'].id, result['buyer'].balance)
+                portfolio_cache.set_balance(result['seller'].id, result['seller'].balance)
+                portfolio_cache.set_holding(result['buyer'].id, event['symbol'], result['holding'])
+
+        if self.settled_listener is not None:
+            user_ids = set()
+            for result in settled:
+                if result['event']['kind'] in ('release', 'reserve'):
+                    user_ids.add(result['user'].id)
+                elif result['event']['kind'] == 'trade':
+                    user_ids.update((result['buyer'].id, result['seller'].id))
+            self.settled_listener(user_ids)
+
+        for result in settled:
+            if result['event']['kind'] == 'release':
+                asyncio.create_task(self._notify_funds_released(result['user'], result['event']))
+                continue
+            if result['event']['kind'] != 'trade':
+                continue
+
+            trade_info = result['event']
+            asyncio.create_task(self._notify_user_update(result['buyer'], 'BUY', trade_info))
+            asyncio.create_task(self._notify_user_update(result['seller'], 'SELL', trade_info))
+
+    def get_stats(self) -> Dict:
+        return {
+            'books': {
+                symbol: {'bid_levels': len(book.bids), 'ask_levels': len(book.asks)}
+                for symbol, book in self.books.items()
+            },
+            'sequencers': {symbol: sequencer.stats() for symbol, sequencer in self.sequencers.items()},
+            'connected_consumers': len(self.connected_trading_consumers),
+            'orderbook_fanout': self.orderbook_hub.stats(),
+            'settlement': self.settlement.stats(),
+            'portfolio_cache': portfolio_cache.stats(),
+            'ledger': self.ledger.stats() if self.ledger is not None else None,
+            'journal': {
+                'enabled': self.journal is not None,
+                'snapshot_seqs': dict(self._snapshot_seqs),
+            },
+        }
 
     async def _notify_user_update(self, user: User, side: str, trade_info: Dict):
         if not self.connected_trading_consumers:
             return
 
         channel_layer = get_channel_layer()
-        holdings = await self._get_user_holdings(user.id)
+        portfolio = await portfolio_cache.get(user.id)
         
         update_data = {
             'type': 'trade_executed',
             'data': {
                 'message': f'Trade executed successfully',
-                'balance': float(user.balance),
-                'holdings': holdings,
+                'balance': float(portfolio.balance),
+                'reserved': self._serialize_reserved(user.id),
+                'holdings': self._serialize_holdings(portfolio),
                 'trade': {
                     'trade_id': trade_info['trade_id'],
                     'side': side,
                     'symbol': trade_info['symbol'],
-                    'price': trade_info['price'],
+                    'price': ticks_to_float(trade_info['symbol'], trade_info['price']),
                     'quantity': trade_info['quantity'],
-                    'total_amount': trade_info['total_amount'],
+                    'total_amount': ticks_to_float(trade_info['symbol'], trade_info['total_amount']),
                     'counterparty': trade_info['seller_email'] if side == 'BUY' else trade_info['buyer_email']
                 },
-                'timestamp': datetime.now().isoformat()+'Z'
+                'timestamp': format_ns(now_ns())
             }
         }
         
         message = json.dumps(update_data)
 
-        tasks = []
-        for channel_name in list(self.connected_trading_consumers):
-            task = channel_layer.send(channel_name, {
-                "type": "user.update",
-                "message": message,
-                "user_id": user.id
-            })
-            tasks.append(task)
-        
-        if tasks:
-            await asyncio.gather(*tasks, return_exceptions=True)
+        await channel_layer.group_send(user_group(user.id), {
+            "type": "user.update",
+            "message": message,
+            "user_id": user.id
+        })
 
-    @sync_to_async
-    def _get_user_holdings(self, user_id: int) -> List[Dict]:
-        try:
-            holdings = Holding.objects.filter(user_id=user_id)
-            return [
-                {
-                    'symbol': h.symbol,
-                    'quantity': h.quantity,
-                    'price': float(h.price),
-                    'total': float(h.total)
-                }
-                for h in holdings
-            ]
-        except Exception as e:
-            return []
+    async def _notify_funds_released(self, user: User, release: Dict):
+        if not self.connected_trading_consumers:
+            return
 
-    def _aggregate_orders_by_price(self, orders: List[Dict], limit: int = 5) -> List[Dict]:
-        price_levels = defaultdict(lambda: {'quantity': 0, 'orders': 0})
-        
-        for order in orders:
-            price = order['price']
-            price_levels[price]['quantity'] += order['remaining_quantity']
-            price_levels[price]['orders'] += 1
-
-        aggregated = []
-        for price, data in price_levels.items():
-            aggregated.append({
-                'price': price,
-                'quantity': data['quantity'],
-                'orders': data['orders']
-            })
-        
-        return aggregated[:limit]
+        channel_layer = get_channel_layer()
+        portfolio = await portfolio_cache.get(user.id)
 
-    def get_orderbook(self) -> Dict:
-        top_buy_orders = self.buy_orders[:10]
-        bids = self._aggregate_orders_by_price(top_buy_orders, 5)
-        bids.sort(key=lambda x: -x['price'])
-        
-        top_sell_orders = self.sell_orders[:10]
-        asks = self._aggregate_orders_by_price(top_sell_orders, 5)
-        asks.sort(key=lambda x: x['price'])
-        
+        message = json.dumps({
+            'type': 'user_update',
+            'data': {
+                'message': 'Order reservation released',
+                'order_id': release['order_id'],
+                'symbol': release['symbol'],
+                'balance': float(portfolio.balance),
+                'reserved': self._serialize_reserved(user.id),
+                'holdings': self._serialize_holdings(portfolio),
+                'timestamp': format_ns(now_ns())
+            }
+        })
+
+        await channel_layer.group_send(user_group(user.id), {
+            "type": "user.update",
+            "message": message,
+            "user_id": user.id
+        })
+
+    def _serialize_holdings(self, portfolio: Portfolio) -> List[Dict]:
+        return [
+            {
+                'symbol': position.symbol,
+                'quantity': position.quantity,
+                'price': float(position.price),
+                'total': float(position.total)
+            }
+            for position in portfolio.holdings
+        ]
+
+    def _serialize_reserved(self, user_id: int) -> Dict:
+        reserved = self.reserved_for(user_id)
+        return {'balance': float(reserved['balance']), 'holdings': reserved['holdings']}
+
+    def reserved_for(self, user_id: int) -> Dict:
+        # What the user has locked in resting orders, read off the books'
+        # exposure tallies.
+        cash = Decimal('0')
+        quantities = {}
+        for symbol, book in list(self.books.items()):
+            ticks = book.bids.exposure.get(user_id)
+            if ticks:
+                cash += from_ticks(symbol, ticks)
+            quantity = book.asks.exposure.get(user_id)
+            if quantity:
+                quantities[symbol] = quantity
+        return {'balance': cash, 'holdings': quantities}
+
+    def _build_orderbook(self, book: OrderBook) -> Dict:
         return {
-            'symbol': 'RELIANCE',
-            'bids': bids,
-            'asks': asks,
-            'timestamp': datetime.now().isoformat()+'Z'
+            'symbol': book.symbol,
+            'seq': book.published_seq,
+            'bids': self._priced_levels(book.symbol, book.bids.depth(ORDERBOOK_DEPTH)),
+            'asks': self._priced_levels(book.symbol, book.asks.depth(ORDERBOOK_DEPTH)),
+            'timestamp': format_ns(now_ns())
         }
 
+    def _priced_levels(self, symbol: str, levels: List[Dict]) -> List[Dict]:
+        for level in levels:
+            level['price'] = ticks_to_float(symbol, level['price'])
+        return levels
+
+    def _encode_orderbook(self, book: OrderBook) -> str:
+        return json.dumps({'type': 'orderbook', 'data': self._build_orderbook(book)})
+
+    def get_orderbook(self, symbol: str = DEFAULT_SYMBOL) -> Dict:
+        return self._build_orderbook(self.books.get(symbol) or OrderBook(symbol))
+
 matching_engine = OrderMatchingEngine()
\ No newline at end of file
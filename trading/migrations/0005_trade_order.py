@@ -0,0 +1,60 @@
+# Generated by Django 4.2.7 on 2026-10-16 21:40
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('trading', '0004_settlementcheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Trade',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('symbol', models.CharField(max_length=10)),
+                ('trade_id', models.BigIntegerField()),
+                ('price', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('quantity', models.IntegerField()),
+                ('total_amount', models.DecimalField(decimal_places=2, max_digits=15)),
+                ('buy_order_id', models.BigIntegerField()),
+                ('sell_order_id', models.BigIntegerField()),
+                ('executed_at', models.DateTimeField()),
+                ('buyer', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='buy_trades', to=settings.AUTH_USER_MODEL)),
+                ('seller', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='sell_trades', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [
+                    models.Index(fields=['symbol', 'executed_at', 'id'], name='trading_trade_symbol_time_idx'),
+                    models.Index(fields=['buyer', 'executed_at', 'id'], name='trading_trade_buyer_time_idx'),
+                    models.Index(fields=['seller', 'executed_at', 'id'], name='trading_trade_seller_time_idx'),
+                ],
+            },
+        ),
+        migrations.CreateModel(
+            name='Order',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('symbol', models.CharField(max_length=10)),
+                ('order_id', models.BigIntegerField()),
+                ('order_type', models.CharField(choices=[('BUY', 'Buy'), ('SELL', 'Sell')], max_length=4)),
+                ('price', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('quantity', models.IntegerField()),
+                ('filled_quantity', models.IntegerField()),
+                ('status', models.CharField(choices=[('FILLED', 'Filled'), ('CANCELLED', 'Cancelled')], max_length=20)),
+                ('created_at', models.DateTimeField()),
+                ('closed_at', models.DateTimeField()),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='orders', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [
+                    models.Index(fields=['user', 'closed_at', 'id'], name='trading_order_user_time_idx'),
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,51 @@
+from django.conf import settings
+from django.db import models
+
+class SettlementCheckpoint(models.Model):
+    symbol = models.CharField(max_length=10, unique=True)
+    seq = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+# Trade and order history, written by the settlement worker in the same
+# transaction as the balances they moved. Rows are only ever appended, so
+# they carry no more indexes than the history queries need; `id` breaks ties
+# between rows with the same timestamp for keyset pagination.
+class Trade(models.Model):
+    symbol = models.CharField(max_length=10)
+    trade_id = models.BigIntegerField()
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+    quantity = models.IntegerField()
+    total_amount = models.DecimalField(max_digits=15, decimal_places=2)
+    buyer = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='buy_trades', db_index=False)
+    seller = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='sell_trades', db_index=False)
+    buy_order_id = models.BigIntegerField()
+    sell_order_id = models.BigIntegerField()
+    executed_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['symbol', 'executed_at', 'id'], name='trading_trade_symbol_time_idx'),
+            models.Index(fields=['buyer', 'executed_at', 'id'], name='trading_trade_buyer_time_idx'),
+            models.Index(fields=['seller', 'executed_at', 'id'], name='trading_trade_seller_time_idx'),
+        ]
+
+
+class Order(models.Model):
+    # The final state of an order, recorded once it is filled or cancelled.
+    # `order_id` is the engine's id, unique within `symbol`.
+    symbol = models.CharField(max_length=10)
+    order_id = models.BigIntegerField()
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='orders', db_index=False)
+    order_type = models.CharField(max_length=4, choices=[('BUY', 'Buy'), ('SELL', 'Sell')])
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+    quantity = models.IntegerField()
+    filled_quantity = models.IntegerField()
+    status = models.CharField(max_length=20, choices=[('FILLED', 'Filled'), ('CANCELLED', 'Cancelled')])
+    created_at = models.DateTimeField()
+    closed_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'closed_at', 'id'], name='trading_order_user_time_idx'),
+        ]
@@ -0,0 +1,273 @@
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Optional, Any, Tuple
+
+
+class Order:
+    # Resting orders are the bulk of the engine's memory, so they are slotted
+    # objects with integer ids, tick prices and integer timestamps. `id` is
+    # the sequence number of the command that placed the order, which makes it
+    # unique within its book and stable across journal replay.
+    __slots__ = ('id', 'user_id', 'user_email', 'symbol', 'order_type', 'price', 'quantity',
+                 'filled_quantity', 'remaining_quantity', 'status', 'created_at')
+
+    def __init__(self, id: int, user_id: int, user_email: str, symbol: str, order_type: str, price: int,
+                 quantity: int, created_at: int, filled_quantity: int = 0, remaining_quantity: int = None,
+                 status: str = 'PENDING'):
+        self.id = id
+        self.user_id = user_id
+        self.user_email = user_email
+        self.symbol = symbol
+        self.order_type = order_type
+        self.price = price
+        self.quantity = quantity
+        self.filled_quantity = filled_quantity
+        self.remaining_quantity = quantity if remaining_quantity is None else remaining_quantity
+        self.status = status
+        self.created_at = created_at
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class PriceLevel:
+    # `quantity` is the total remaining quantity resting at this price and is
+    # kept up to date by every insert, fill, reduction and removal.
+    __slots__ = ('price', 'orders', 'quantity')
+
+    def __init__(self, price):
+        self.price = price
+        self.orders: 'OrderedDict[int, Order]' = OrderedDict()
+        self.quantity = 0
+
+    def __len__(self):
+        return len(self.orders)
+
+    def append(self, order: Order):
+        self.orders[order.id] = order
+        self.quantity += order.remaining_quantity
+
+    def peek(self) -> Order:
+        return next(iter(self.orders.values()))
+
+    def popleft(self) -> Order:
+        order = self.orders.popitem(last=False)[1]
+        self.quantity -= order.remaining_quantity
+        return order
+
+    def pop(self, order_id: int) -> Order:
+        order = self.orders.pop(order_id)
+        self.quantity -= order.remaining_quantity
+        return order
+
+    def fill(self, order: Order, quantity: int):
+        order.filled_quantity += quantity
+        order.remaining_quantity -= quantity
+        self.quantity -= quantity
+
+    def reduce(self, order: Order, remaining_quantity: int):
+        self.quantity -= order.remaining_quantity - remaining_quantity
+        order.quantity -= order.remaining_quantity - remaining_quantity
+        order.remaining_quantity = remaining_quantity
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'price': self.price,
+            'quantity': self.quantity,
+            'orders': len(self.orders)
+        }
+
+
+class BookSide:
+    # Prices are kept in an ascending list of sort keys with the best level
+    # last, so removing an exhausted best level is a plain list.pop().
+    # The book's `index` is shared by both sides and maps an order id to its
+    # side and level; the level's OrderedDict keeps the order's queue
+    # position, so an order can be unlinked in O(1) without a scan.
+    # `exposure` holds what each user has locked in resting orders on this
+    # side: ticks * quantity for bids, quantity for asks.
+    def __init__(self, book: 'OrderBook', is_bid: bool):
+        self.book = book
+        self.is_bid = is_bid
+        self.index = book.index
+        self.exposure: Dict[int, int] = {}
+        self._keys: List[int] = []
+        self._levels: Dict[int, PriceLevel] = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __bool__(self):
+        return bool(self._keys)
+
+    def _key(self, price):
+        return price if self.is_bid else -price
+
+    def _expose(self, order: Order, quantity: int):
+        total = self.exposure.get(order.user_id, 0) + (order.price * quantity if self.is_bid else quantity)
+        if total:
+            self.exposure[order.user_id] = total
+        else:
+            self.exposure.pop(order.user_id, None)
+
+    def add(self, order: Order):
+        price = order.price
+        level = self._levels.get(price)
+        if level is None:
+            level = PriceLevel(price)
+            self._levels[price] = level
+            key = self._key(price)
+            self._keys.insert(bisect_left(self._keys, key), key)
+        level.append(order)
+        self.index[order.id] = (self, level)
+        self._expose(order, order.remaining_quantity)
+        self.book.version += 1
+
+    def best_level(self) -> Optional[PriceLevel]:
+        if not self._keys:
+            return None
+        return self._levels[self._key(self._keys[-1])]
+
+    def best_order(self) -> Optional[Order]:
+        level = self.best_level()
+        return level.peek() if level is not None else None
+
+    def fill(self, level: PriceLevel, order: Order, quantity: int):
+        level.fill(order, quantity)
+        self._expose(order, -quantity)
+        self.book.version += 1
+
+    def pop_best_order(self) -> Order:
+        level = self._levels[self._key(self._keys[-1])]
+        order = level.popleft()
+        del self.index[order.id]
+        if order.remaining_quantity:
+            self._expose(order, -order.remaining_quantity)
+        if not level:
+            del self._levels[level.price]
+            self._keys.pop()
+        self.book.version += 1
+        return order
+
+    def remove(self, level: PriceLevel, order_id: int) -> Order:
+        order = level.pop(order_id)
+        del self.index[order_id]
+        self._expose(order, -order.remaining_quantity)
+        if not level:
+            del self._levels[level.price]
+            key = self._key(level.price)
+            if self._keys[-1] == key:
+                self._keys.pop()
+            else:
+                del self._keys[bisect_left(self._keys, key)]
+        self.book.version += 1
+        return order
+
+    def levels(self) -> Iterator[PriceLevel]:
+        for key in reversed(self._keys):
+            yield self._levels[self._key(key)]
+
+    def depth(self, limit: int) -> List[Dict[str, Any]]:
+        depth = []
+        for level in self.levels():
+            if len(depth) >= limit:
+                break
+            depth.append(level.to_dict())
+        return depth
+
+    def orders(self, limit: Optional[int] = None) -> Iterator[Order]:
+        count = 0
+        for level in self.levels():
+            for order in level.orders.values():
+                if limit is not None and count >= limit:
+                    return
+                yield order
+                count += 1
+
+
+class OrderBook:
+    # `version` increases on every change to the book. Trades are numbered
+    # per book by `trade_seq`, assigned in match order. Market data is
+    # published as deltas between successive top-of-book views; `published_seq`
+    # is the version of the last view sent out, and snapshots are labelled
+    # with it so a client can apply the following deltas on top.
+    def __init__(self, symbol: str):
+        self.symbol = symbol
+        self.version = 0
+        self.trade_seq = 0
+        self.index: Dict[int, Tuple[BookSide, PriceLevel]] = {}
+        self.bids = BookSide(self, is_bid=True)
+        self.asks = BookSide(self, is_bid=False)
+        self.published_seq = 0
+        self._published_view: Dict[Tuple[str, int], Tuple[int, int]] = {}
+        self._checked_version = 0
+        self._snapshot_seq = None
+        self._snapshot_message = None
+
+    def __contains__(self, order_id):
+        return order_id in self.index
+
+    def add(self, order: Order):
+        if order.order_type == 'BUY':
+            self.bids.add(order)
+        else:
+            self.asks.add(order)
+
+    def next_trade_id(self) -> int:
+        self.trade_seq += 1
+        return self.trade_seq
+
+    def get(self, order_id: int) -> Optional[Order]:
+        entry = self.index.get(order_id)
+        if entry is None:
+            return None
+        return entry[1].orders[order_id]
+
+    def remove(self, order_id: int) -> Optional[Order]:
+        entry = self.index.get(order_id)
+        if entry is None:
+            return None
+        side, level = entry
+        return side.remove(level, order_id)
+
+    def reduce(self, order_id: int, remaining_quantity: int):
+        side, level = self.index[order_id]
+        order = level.orders[order_id]
+        side._expose(order, remaining_quantity - order.remaining_quantity)
+        level.reduce(order, remaining_quantity)
+        self.version += 1
+
+    def depth_view(self, limit: int) -> Dict[Tuple[str, int], Tuple[int, int]]:
+        view = {}
+        for side_name, side in (('bid', self.bids), ('ask', self.asks)):
+            for count, level in enumerate(side.levels()):
+                if count >= limit:
+                    break
+                view[(side_name, level.price)] = (level.quantity, len(level))
+        return view
+
+    def take_delta(self, limit: int) -> Optional[Tuple[int, int, List[Dict[str, Any]]]]:
+        if self.version == self._checked_version:
+            return None
+        self._checked_version = self.version
+
+        view = self.depth_view(limit)
+        changes = []
+        for (side_name, price), (quantity, orders) in view.items():
+            if self._published_view.get((side_name, price)) != (quantity, orders):
+                changes.append({'side': side_name, 'price': price, 'quantity': quantity, 'orders': orders})
+        for side_name, price in self._published_view.keys() - view.keys():
+            changes.append({'side': side_name, 'price': price, 'quantity': 0, 'orders': 0})
+        if not changes:
+            return None
+
+        prev_seq = self.published_seq
+        self.published_seq = self.version
+        self._published_view = view
+        return prev_seq, self.published_seq, changes
+
+    def cached_snapshot(self, build) -> str:
+        if self._snapshot_seq != self.published_seq or self._snapshot_message is None:
+            self._snapshot_message = build(self)
+            self._snapshot_seq = self.published_seq
+        return self._snapshot_message
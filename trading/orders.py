@@ -0,0 +1,189 @@
+import logging
+from decimal import Decimal
+from typing import Dict, List, Optional, Tuple
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+
+from accounts.models import Holding
+from .gateway import gateway
+from .matching_engine import normalize_symbol
+from .ticks import from_ticks, ticks_to_float, to_ticks
+
+User = get_user_model()
+logger = logging.getLogger(__name__)
+
+
+def parse_order(order_data) -> Dict:
+    if not isinstance(order_data, dict):
+        raise ValueError('Order must be an object')
+    for field in ('order_type', 'price', 'quantity'):
+        if field not in order_data:
+            raise ValueError(f'Missing required field: {field}')
+
+    symbol = normalize_symbol(order_data.get('symbol'))
+    order_type = str(order_data['order_type']).upper()
+    if order_type not in ('BUY', 'SELL'):
+        raise ValueError('Order type must be BUY or SELL')
+    price = to_ticks(symbol, order_data['price'])
+    quantity = int(order_data['quantity'])
+    if price <= 0 or quantity <= 0:
+        raise ValueError('Price and quantity must be positive')
+
+    return {
+        'symbol': symbol,
+        'order_type': order_type,
+        'price': price,
+        'quantity': quantity
+    }
+
+
+def reserve_for_orders(user_id: int, orders: List[Dict]) -> Tuple[List[Optional[str]], Decimal, Dict[str, Holding]]:
+    # Reserves balance for buys and holdings for sells of a whole basket under
+    # one lock. Orders are taken in sequence until the funds run out; the
+    # result holds an error for every order that could not be reserved, plus
+    # the balance and holdings as committed.
+    errors = []
+    with transaction.atomic():
+        user = User.objects.select_for_update().get(id=user_id)
+        holdings = {}
+        for holding in Holding.objects.select_for_update().filter(
+            user_id=user_id,
+            symbol__in={order['symbol'] for order in orders if order['order_type'] == 'SELL'}
+        ):
+            holdings.setdefault(holding.symbol, holding)
+
+        balance = user.balance
+        touched_holdings = set()
+        for order in orders:
+            if order['order_type'] == 'BUY':
+                amount = from_ticks(order['symbol'], order['price'] * order['quantity'])
+                if amount > balance:
+                    errors.append(f'Insufficient balance. Required: {amount}')
+                    continue
+                balance -= amount
+            else:
+                holding = holdings.get(order['symbol'])
+                if holding is None or holding.quantity < order['quantity']:
+                    errors.append('Insufficient holdings for sell order')
+                    continue
+                holding.quantity -= order['quantity']
+                touched_holdings.add(order['symbol'])
+            errors.append(None)
+
+        if balance != user.balance:
+            user.balance = balance
+            user.save(update_fields=['balance'])
+        for symbol in touched_holdings:
+            holding = holdings[symbol]
+            if holding.quantity <= 0:
+                holding.delete()
+            else:
+                holding.save()
+
+    return errors, user.balance, {symbol: holdings[symbol] for symbol in touched_holdings}
+
+
+def refund_orders(user_id: int, orders: List[Dict]) -> Tuple[Decimal, Dict[str, Holding]]:
+    # Gives back what reserve_for_orders took for orders that never reached
+    # the book. Returns the balance and holdings as committed.
+    with transaction.atomic():
+        user = User.objects.select_for_update().get(id=user_id)
+        holdings = {}
+        for holding in Holding.objects.select_for_update().filter(
+            user_id=user_id,
+            symbol__in={order['symbol'] for order in orders if order['order_type'] == 'SELL'}
+        ):
+            holdings.setdefault(holding.symbol, holding)
+
+        balance = user.balance
+        touched_holdings = set()
+        for order in orders:
+            if order['order_type'] == 'BUY':
+                balance += from_ticks(order['symbol'], order['price'] * order['quantity'])
+                continue
+            holding = holdings.get(order['symbol'])
+            if holding is None:
+                price = from_ticks(order['symbol'], order['price'])
+                holding = Holding(user=user, symbol=order['symbol'], quantity=0, price=price, total=0)
+                holdings[order['symbol']] = holding
+            holding.quantity += order['quantity']
+            touched_holdings.add(order['symbol'])
+
+        if balance != user.balance:
+            user.balance = balance
+            user.save(update_fields=['balance'])
+        for symbol in touched_holdings:
+            holdings[symbol].save()
+
+    return user.balance, {symbol: holdings[symbol] for symbol in touched_holdings}
+
+
+async def place_order_batch(user, orders_data) -> List[Dict]:
+    if not isinstance(orders_data, list) or not orders_data:
+        raise ValueError('orders must be a non-empty list')
+    if len(orders_data) > settings.TRADING_MAX_BATCH_ORDERS:
+        raise ValueError(f'A batch can hold at most {settings.TRADING_MAX_BATCH_ORDERS} orders')
+
+    results: List[Dict] = [None] * len(orders_data)
+    parsed = []
+    for index, order_data in enumerate(orders_data):
+        try:
+            parsed.append((index, parse_order(order_data)))
+        except (ValueError, TypeError) as e:
+            results[index] = {'index': index, 'success': False, 'error': str(e)}
+    if not parsed:
+        return results
+
+    if settings.TRADING_RESERVATION_LEDGER:
+        # The engine reserves each order itself and rejects what it cannot
+        # cover; see ReservationLedger.
+        errors = [None] * len(parsed)
+    else:
+        errors, balance, holdings = await database_sync_to_async(reserve_for_orders)(
+            user.id, [order for _, order in parsed]
+        )
+        await gateway.portfolio_changed(user.id, balance=balance, holdings=holdings)
+    accepted = []
+    for (index, order), error in zip(parsed, errors):
+        if error is None:
+            accepted.append((index, order))
+        else:
+            results[index] = {'index': index, 'success': False, 'error': error}
+    if not accepted:
+        return results
+
+    try:
+        placed = await gateway.add_orders([
+            dict(order, user_id=user.id, user_email=user.email) for _, order in accepted
+        ])
+    except Exception as e:
+        placed = [e] * len(accepted)
+
+    failed = [order for (_, order), result in zip(accepted, placed) if isinstance(result, Exception)]
+    if failed and not settings.TRADING_RESERVATION_LEDGER:
+        balance, holdings = await database_sync_to_async(refund_orders)(user.id, failed)
+        await gateway.portfolio_changed(user.id, balance=balance, holdings=holdings)
+
+    for (index, order), result in zip(accepted, placed):
+        if isinstance(result, Exception):
+            logger.error(f"Failed to place batch order {index} for user {user.id}: {result}")
+            results[index] = {'index': index, 'success': False, 'error': 'Failed to place order'}
+            continue
+        if not result['success']:
+            results[index] = {'index': index, 'success': False, 'error': result['error']}
+            continue
+        results[index] = {
+            'index': index,
+            'success': True,
+            'order_id': result['order']['id'],
+            'symbol': order['symbol'],
+            'order_type': order['order_type'],
+            'price': ticks_to_float(order['symbol'], order['price']),
+            'quantity': order['quantity'],
+            'matches': len(result['matches'])
+        }
+
+    return results
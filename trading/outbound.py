@@ -0,0 +1,106 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class OutboundQueue:
+    # Frames waiting to go out on one WebSocket, written by a single task so a
+    # slow socket only ever holds itself up. Plain frames are delivered in
+    # order. Frames put under a `key` are conflated: while one is still
+    # waiting, a newer frame for the same key replaces it in place (or
+    # `supersede()` does, when the frames are not self-contained). A key whose
+    # frame was replaced without `supersede()` is left in `gaps` until
+    # resync() puts a self-contained frame in its place. Once more than
+    # `max_pending` frames are waiting, or the oldest has waited longer than
+    # `max_lag_seconds`, the queue stops accepting frames and calls `on_drop`
+    # so the connection can be dropped.
+    def __init__(self, send: Callable[[str], Awaitable[None]], on_drop: Callable[[], None],
+                 max_pending: int, max_lag_seconds: float):
+        self._send = send
+        self._on_drop = on_drop
+        self.max_pending = max_pending
+        self.max_lag_seconds = max_lag_seconds
+        self._entries = deque()
+        self._keyed: Dict[str, list] = {}
+        self.gaps = set()
+        self._ready = asyncio.Event()
+        self._task = None
+        self.closed = False
+        self.sent = 0
+        self.conflated = 0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def close(self):
+        self.closed = True
+        self._entries.clear()
+        self._keyed.clear()
+        self.gaps.clear()
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def put(self, frame: str, key: Optional[str] = None, supersede: Optional[Callable[[], str]] = None):
+        if self.closed:
+            return
+        if key is not None:
+            entry = self._keyed.get(key)
+            if entry is not None:
+                if supersede is not None:
+                    entry[1] = supersede()
+                else:
+                    entry[1] = frame
+                    self.gaps.add(key)
+                self.conflated += 1
+                # A replaced frame keeps its place and its age, so a socket
+                # fed only keyed frames still falls behind.
+                self._check_backlog(time.monotonic())
+                return
+
+        entry = [key, frame, time.monotonic()]
+        self._entries.append(entry)
+        if key is not None:
+            self._keyed[key] = entry
+        self._ready.set()
+        self._check_backlog(entry[2])
+
+    def _check_backlog(self, now: float):
+        if len(self._entries) > self.max_pending or now - self._entries[0][2] > self.max_lag_seconds:
+            logger.warning(f"Outbound queue overflow: {len(self._entries)} frames waiting")
+            self.close()
+            self._on_drop()
+
+    def resync(self, key: str, frame: str) -> bool:
+        # Puts a self-contained `frame` in place of what a gap under `key`
+        # lost; does nothing when there was no gap.
+        if key not in self.gaps:
+            return False
+        self.gaps.discard(key)
+        self.put(frame, key, lambda: frame)
+        return True
+
+    async def _run(self):
+        while not self.closed:
+            if not self._entries:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+
+            key, frame, _ = self._entries.popleft()
+            if key is not None:
+                del self._keyed[key]
+            try:
+                await self._send(frame)
+                self.sent += 1
+            except Exception as e:
+                logger.error(f"Error sending frame: {e}")
+                self.close()
+                self._on_drop()
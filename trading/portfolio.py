@@ -0,0 +1,135 @@
+import asyncio
+import time
+from decimal import Decimal
+from typing import Dict, List, Optional
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+
+from accounts.models import Holding
+
+User = get_user_model()
+
+CENT = Decimal('0.01')
+
+
+class Position:
+    __slots__ = ('symbol', 'quantity', 'price', 'total', 'timestamp')
+
+    def __init__(self, holding: Holding):
+        self.symbol = holding.symbol
+        self.quantity = holding.quantity
+        # Stored the way the database rounds them, so cached reads match.
+        self.price = holding.price.quantize(CENT)
+        self.total = (holding.quantity * holding.price).quantize(CENT)
+        self.timestamp = holding.timestamp
+
+
+class Portfolio:
+    __slots__ = ('user_id', 'balance', 'positions', 'last_used')
+
+    def __init__(self, user_id: int, balance: Decimal, positions: Dict[str, Position]):
+        self.user_id = user_id
+        self.balance = balance
+        self.positions = positions
+        self.last_used = time.monotonic()
+
+    @property
+    def holdings(self) -> List[Position]:
+        return sorted(self.positions.values(), key=lambda position: position.timestamp, reverse=True)
+
+
+class PortfolioCache:
+    # Committed balance and holdings per user, as last written by settlement or
+    # by an order reservation in this process. Entries are loaded from the
+    # database on first use and dropped after `idle_seconds` without a read.
+    # Updates that arrive while an entry is loading mark it dirty and the load
+    # is repeated, so a load never overwrites a newer write.
+    def __init__(self, idle_seconds: float):
+        self.idle_seconds = idle_seconds
+        self._entries: Dict[int, Portfolio] = {}
+        self._loads: Dict[int, asyncio.Future] = {}
+        self._dirty = set()
+        self._last_sweep = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> Dict:
+        return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+    def peek(self, user_id: int) -> Optional[Portfolio]:
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            entry.last_used = time.monotonic()
+            self.hits += 1
+        return entry
+
+    async def get(self, user_id: int) -> Portfolio:
+        self._evict_idle()
+        entry = self.peek(user_id)
+        if entry is not None:
+            return entry
+
+        load = self._loads.get(user_id)
+        if load is None:
+            load = asyncio.ensure_future(self._load(user_id))
+            self._loads[user_id] = load
+            load.add_done_callback(lambda _: self._loads.pop(user_id, None))
+        return await load
+
+    async def _load(self, user_id: int) -> Portfolio:
+        self.misses += 1
+        while True:
+            self._dirty.discard(user_id)
+            balance, holdings = await database_sync_to_async(self._read)(user_id)
+            if user_id not in self._dirty:
+                break
+
+        positions = {}
+        for holding in holdings:
+            positions.setdefault(holding.symbol, Position(holding))
+        entry = Portfolio(user_id, balance, positions)
+        self._entries[user_id] = entry
+        return entry
+
+    def _read(self, user_id: int):
+        balance = User.objects.values_list('balance', flat=True).get(id=user_id)
+        return balance, list(Holding.objects.filter(user_id=user_id))
+
+    def set_balance(self, user_id: int, balance: Decimal):
+        if user_id in self._loads:
+            self._dirty.add(user_id)
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            entry.balance = balance.quantize(CENT)
+
+    def set_holding(self, user_id: int, symbol: str, holding: Optional[Holding]):
+        if user_id in self._loads:
+            self._dirty.add(user_id)
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return
+        if holding is None or holding.quantity <= 0:
+            entry.positions.pop(symbol, None)
+        else:
+            entry.positions[symbol] = Position(holding)
+
+    def invalidate(self, user_id: int):
+        # For writes committed by another process; the entry is reloaded on
+        # next use.
+        if user_id in self._loads:
+            self._dirty.add(user_id)
+        self._entries.pop(user_id, None)
+
+    def _evict_idle(self):
+        now = time.monotonic()
+        if now - self._last_sweep < self.idle_seconds / 2:
+            return
+        self._last_sweep = now
+        for user_id, entry in list(self._entries.items()):
+            if now - entry.last_used > self.idle_seconds:
+                del self._entries[user_id]
+
+
+portfolio_cache = PortfolioCache(settings.TRADING_PORTFOLIO_IDLE_SECONDS)
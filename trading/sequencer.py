@@ -0,0 +1,164 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class Command:
+    __slots__ = ('seq', 'kind', 'payload', 'future')
+
+    def __init__(self, seq: int, kind: str, payload: Dict, future: asyncio.Future):
+        self.seq = seq
+        self.kind = kind
+        self.payload = payload
+        self.future = future
+
+
+class BookSequencer:
+    # Single writer for one symbol's book. Every mutation is enqueued as a
+    # command stamped with the next sequence number and applied by one task,
+    # so commands never interleave and are applied in sequence order. The
+    # handler runs synchronously; side effects it records in `events` are
+    # tagged with the command's sequence number and handed to `on_batch` once
+    # per drained batch, still in sequence order. With a journal, each command
+    # is logged before it is applied and the log is flushed once per batch,
+    # before any caller sees its result.
+    def __init__(self, symbol: str,
+                 handler: Callable[[str, Dict, int, List[Dict]], Any],
+                 on_batch: Callable[[str, List[Dict]], Awaitable[None]],
+                 batch_size: int = 256, journal=None):
+        self.symbol = symbol
+        self.handler = handler
+        self.on_batch = on_batch
+        self.batch_size = batch_size
+        self.journal = journal
+        self.last_seq = 0
+        self.applied_seq = 0
+        self.batch_count = 0
+        self._queue: asyncio.Queue = None
+        self._task = None
+        self._loop = None
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def stats(self) -> Dict:
+        return {
+            'last_seq': self.last_seq,
+            'applied_seq': self.applied_seq,
+            'queue_depth': self.depth,
+            'batches': self.batch_count,
+        }
+
+    def _ensure_running(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # The queue and its task belong to the loop that made them, and
+            # would never wake up for another one.
+            if self._loop is not None:
+                logger.warning(f"{self.symbol} sequencer moved to a new event loop")
+                self._abandon()
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._task = None
+        if self._task is not None and self._task.done():
+            if not self._task.cancelled() and self._task.exception() is not None:
+                logger.error(f"{self.symbol} sequencer stopped: {self._task.exception()}")
+            self._task = None
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def _abandon(self):
+        # Fails whatever the old loop's task had not taken yet and stops it.
+        def stop(task, commands):
+            for command in commands:
+                if not command.future.done():
+                    command.future.set_exception(RuntimeError(f'{self.symbol} sequencer was restarted'))
+            if task is not None:
+                task.cancel()
+
+        commands = []
+        while self._queue is not None and not self._queue.empty():
+            commands.append(self._queue.get_nowait())
+        try:
+            self._loop.call_soon_threadsafe(stop, self._task, commands)
+        except RuntimeError:
+            # The old loop is closed; nothing can be waiting on it any more.
+            pass
+
+    def submit(self, kind: str, payload: Dict) -> asyncio.Future:
+        self._ensure_running()
+        self.last_seq += 1
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(Command(self.last_seq, kind, payload, future))
+        return future
+
+    def apply(self, kind: str, payload: Dict, seq: int, events: List[Dict]) -> Any:
+        first_event = len(events)
+        try:
+            return self.handler(kind, payload, seq, events)
+        finally:
+            for event in events[first_event:]:
+                event['seq'] = seq
+
+    def replay(self, entries: Iterable[Tuple[int, str, Dict]]) -> List[Dict]:
+        events = []
+        for seq, kind, payload in entries:
+            try:
+                self.apply(kind, payload, seq, events)
+            except Exception as e:
+                logger.error(f"Error replaying {kind} #{seq} on {self.symbol}: {e}", exc_info=True)
+            self.last_seq = self.applied_seq = seq
+        return events
+
+    async def _run(self):
+        # Only failures of the commands themselves are handled here. Anything
+        # else (the queue or the loop) ends the task, and the next submit
+        # starts a new one.
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            if self.journal is not None:
+                position = None
+                try:
+                    position = self.journal.position(self.symbol)
+                    for command in batch:
+                        self.journal.append(self.symbol, command.seq, command.kind, command.payload)
+                    self.journal.flush(self.symbol)
+                except Exception as e:
+                    # Nothing in the batch has been applied, so reject all of
+                    # it, and take back the part that reached the journal so
+                    # recovery does not replay it.
+                    logger.error(f"Error journaling {self.symbol} commands: {e}", exc_info=True)
+                    if position is not None:
+                        try:
+                            self.journal.rollback(self.symbol, position)
+                        except Exception as rollback_error:
+                            logger.error(f"Error rolling back {self.symbol} journal: {rollback_error}", exc_info=True)
+                    for command in batch:
+                        if not command.future.done():
+                            command.future.set_exception(e)
+                    continue
+
+            events = []
+            for command in batch:
+                try:
+                    result = self.apply(command.kind, command.payload, command.seq, events)
+                except Exception as e:
+                    logger.error(f"Error applying {command.kind} #{command.seq} on {self.symbol}: {e}", exc_info=True)
+                    if not command.future.done():
+                        command.future.set_exception(e)
+                else:
+                    if not command.future.done():
+                        command.future.set_result(result)
+                self.applied_seq = command.seq
+
+            self.batch_count += 1
+            try:
+                await self.on_batch(self.symbol, events)
+            except Exception as e:
+                logger.error(f"Error handing off {self.symbol} batch: {e}", exc_info=True)
@@ -0,0 +1,336 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict, deque
+from typing import Awaitable, Callable, Dict, List
+
+from channels.db import database_sync_to_async
+from django.contrib.auth import get_user_model
+from django.db import transaction
+
+from accounts.models import Holding
+from .clock import to_datetime
+from .models import Order, SettlementCheckpoint, Trade
+from .ticks import from_ticks
+
+User = get_user_model()
+logger = logging.getLogger(__name__)
+
+
+class SettlementWorker:
+    # Applies fill events produced by the matching engine, the reservation of
+    # funds/holdings taken by the engine's ledger, and the release of reserved
+    # funds/holdings for cancelled or reduced orders, to User.balance and
+    # Holding rows. Events are settled strictly in submission order by a single
+    # task, so updates for any one account are applied in the order they were
+    # matched; each drained batch is committed in one transaction.
+    # Every event carries the symbol and sequence number of the engine command
+    # that produced it. Events of one command are never split across
+    # transactions, and the highest settled sequence per symbol is committed
+    # with them as a SettlementCheckpoint, which tells journal replay which
+    # fills are already in the database. Trades and closed orders are added
+    # to the history tables in the same transaction, one bulk insert each.
+    def __init__(self, on_settled: Callable[[List[Dict]], Awaitable[None]],
+                 max_queue_size: int = 10000, batch_size: int = 500,
+                 on_dropped: Callable[[List[Dict]], None] = None):
+        self.on_settled = on_settled
+        self.on_dropped = on_dropped
+        self.max_queue_size = max_queue_size
+        self.batch_size = batch_size
+        self._queue: asyncio.Queue = None
+        self._task = None
+        self._pending_since = deque()
+        self._depth = 0
+        self._submitted = 0
+        self._completed = 0
+        self._waiters = []
+        self.settled_count = 0
+        self.failed_count = 0
+        self.batch_count = 0
+        self.last_batch_size = 0
+        self.last_batch_ms = 0.0
+
+    @property
+    def depth(self) -> int:
+        return self._depth
+
+    @property
+    def lag(self) -> float:
+        if not self._pending_since:
+            return 0.0
+        return time.monotonic() - self._pending_since[0][0]
+
+    def stats(self) -> Dict:
+        return {
+            'queue_depth': self.depth,
+            'max_queue_size': self.max_queue_size,
+            'lag_ms': round(self.lag * 1000, 3),
+            'settled': self.settled_count,
+            'failed': self.failed_count,
+            'batches': self.batch_count,
+            'last_batch_size': self.last_batch_size,
+            'last_batch_ms': round(self.last_batch_ms, 3),
+        }
+
+    def _ensure_running(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def submit(self, events: List[Dict]):
+        if not events:
+            return
+        self._ensure_running()
+        await self._queue.put(events)
+        self._pending_since.append((time.monotonic(), len(events)))
+        self._depth += len(events)
+        self._submitted += 1
+
+    async def wait_settled(self):
+        # Resolves once everything submitted before the call has been through
+        # a settlement attempt.
+        target = self._submitted
+        if self._completed >= target:
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((target, future))
+        await future
+
+    def _wake_waiters(self):
+        waiting = []
+        for target, future in self._waiters:
+            if target <= self._completed:
+                if not future.done():
+                    future.set_result(None)
+            else:
+                waiting.append((target, future))
+        self._waiters = waiting
+
+    async def _run(self):
+        while True:
+            try:
+                batch = list(await self._queue.get())
+                drained = 1
+                while len(batch) < self.batch_size and not self._queue.empty():
+                    batch.extend(self._queue.get_nowait())
+                    drained += 1
+
+                started = time.perf_counter()
+                settled = await self._settle(batch)
+                self.last_batch_ms = (time.perf_counter() - started) * 1000
+                self.last_batch_size = len(batch)
+                self.batch_count += 1
+                self.settled_count += len(settled)
+                self.failed_count += len(batch) - len(settled)
+
+                for _ in range(drained):
+                    self._pending_since.popleft()
+                self._depth -= len(batch)
+                self._completed += drained
+                self._wake_waiters()
+
+                if len(settled) < len(batch) and self.on_dropped is not None:
+                    kept = {id(result['event']) for result in settled}
+                    self.on_dropped([event for event in batch if id(event) not in kept])
+                if settled:
+                    await self.on_settled(settled)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error in settlement worker: {e}", exc_info=True)
+
+    async def _settle(self, batch: List[Dict]) -> List[Dict]:
+        try:
+            return await database_sync_to_async(self._apply_batch)(batch)
+        except Exception as e:
+            logger.error(f"Settlement batch of {len(batch)} failed, retrying one by one: {e}", exc_info=True)
+
+        settled = []
+        for command_events in self._group_by_command(batch):
+            try:
+                settled.extend(await database_sync_to_async(self._apply_batch)(command_events))
+            except Exception as e:
+                event = command_events[0]
+                logger.error(f"Failed to settle events of {event['symbol']} #{event['seq']}: {e}", exc_info=True)
+        return settled
+
+    def _group_by_command(self, batch: List[Dict]) -> List[List[Dict]]:
+        groups = []
+        for event in batch:
+            if groups and (groups[-1][0]['symbol'], groups[-1][0]['seq']) == (event['symbol'], event['seq']):
+                groups[-1].append(event)
+            else:
+                groups.append([event])
+        return groups
+
+    def _apply_batch(self, batch: List[Dict]) -> List[Dict]:
+        user_ids = set()
+        holding_keys = set()
+        checkpoints = {}
+        for event in batch:
+            checkpoints[event['symbol']] = max(checkpoints.get(event['symbol'], 0), event['seq'])
+            if event['kind'] == 'order':
+                continue
+            if event['kind'] in ('release', 'reserve'):
+                user_ids.add(event['user_id'])
+                if event['quantity']:
+                    holding_keys.add((event['user_id'], event['symbol']))
+                continue
+            user_ids.add(event['buyer_id'])
+            user_ids.add(event['seller_id'])
+            holding_keys.add((event['buyer_id'], event['symbol']))
+
+        settled = []
+        with transaction.atomic():
+            users = {
+                user.id: user
+                for user in User.objects.select_for_update().filter(id__in=user_ids).order_by('id')
+            }
+
+            holdings = {}
+            for holding in Holding.objects.select_for_update().filter(
+                user_id__in={user_id for user_id, _ in holding_keys},
+                symbol__in={symbol for _, symbol in holding_keys},
+            ):
+                holdings.setdefault((holding.user_id, holding.symbol), holding)
+
+            # Balance changes are summed in ticks per (user, symbol) and turned
+            # into money once per batch.
+            balance_ticks = defaultdict(int)
+            touched_holdings = set()
+            trades = []
+            orders = []
+            for event in batch:
+                if event['kind'] == 'order':
+                    orders.append(Order(
+                        symbol=event['symbol'],
+                        order_id=event['order_id'],
+                        user_id=event['user_id'],
+                        order_type=event['order_type'],
+                        price=from_ticks(event['symbol'], event['price']),
+                        quantity=event['quantity'],
+                        filled_quantity=event['filled_quantity'],
+                        status=event['status'],
+                        created_at=to_datetime(event['created_at']),
+                        closed_at=to_datetime(event['closed_at'])
+                    ))
+                    settled.append({'event': event})
+                    continue
+
+                if event['kind'] == 'reserve':
+                    user = users.get(event['user_id'])
+                    if user is None:
+                        logger.error(f"Dropping reservation for order {event['order_id']}: user not found")
+                        continue
+                    key = (user.id, event['symbol'])
+                    if event['amount']:
+                        balance_ticks[key] -= event['amount']
+                    if event['quantity']:
+                        holding = holdings.get(key)
+                        if holding is None:
+                            logger.error(f"Dropping reservation for order {event['order_id']}: holding not found")
+                            continue
+                        holding.quantity -= event['quantity']
+                        holding.total = holding.quantity * holding.price
+                        touched_holdings.add(key)
+                    settled.append({'event': event, 'user': user, 'holding': holdings.get(key)})
+                    continue
+
+                if event['kind'] == 'release':
+                    user = users.get(event['user_id'])
+                    if user is None:
+                        logger.error(f"Dropping release for order {event['order_id']}: user not found")
+                        continue
+                    if event['amount']:
+                        balance_ticks[(user.id, event['symbol'])] += event['amount']
+                    if event['quantity']:
+                        key = (user.id, event['symbol'])
+                        holding = holdings.get(key)
+                        if holding is None:
+                            price = from_ticks(event['symbol'], event['price'])
+                            holding = Holding(
+                                user=user,
+                                symbol=event['symbol'],
+                                quantity=event['quantity'],
+                                price=price,
+                                total=price * event['quantity']
+                            )
+                            holdings[key] = holding
+                        else:
+                            holding.quantity += event['quantity']
+                        touched_holdings.add(key)
+                    settled.append({'event': event, 'user': user, 'holding': holdings.get((user.id, event['symbol']))})
+                    continue
+
+                buyer = users.get(event['buyer_id'])
+                seller = users.get(event['seller_id'])
+                if buyer is None or seller is None:
+                    logger.error(f"Dropping trade {event['trade_id']}: user not found")
+                    continue
+
+                symbol = event['symbol']
+                trade_quantity = event['quantity']
+                if event['buy_price'] > event['price']:
+                    balance_ticks[(buyer.id, symbol)] += (event['buy_price'] - event['price']) * trade_quantity
+                balance_ticks[(seller.id, symbol)] += event['total_amount']
+
+                trade_price = from_ticks(symbol, event['price'])
+                total_amount = from_ticks(symbol, event['total_amount'])
+                key = (buyer.id, symbol)
+                holding = holdings.get(key)
+                if holding is None:
+                    holding = Holding(
+                        user=buyer,
+                        symbol=symbol,
+                        quantity=trade_quantity,
+                        price=trade_price,
+                        total=total_amount
+                    )
+                    holdings[key] = holding
+                else:
+                    new_quantity = holding.quantity + trade_quantity
+                    new_total = holding.total + total_amount
+                    holding.price = new_total / new_quantity if new_quantity > 0 else trade_price
+                    holding.quantity = new_quantity
+                    holding.total = new_total
+                touched_holdings.add(key)
+                trades.append(Trade(
+                    symbol=symbol,
+                    trade_id=event['trade_id'],
+                    price=trade_price,
+                    quantity=trade_quantity,
+                    total_amount=total_amount,
+                    buyer=buyer,
+                    seller=seller,
+                    buy_order_id=event['buy_order_id'],
+                    sell_order_id=event['sell_order_id'],
+                    executed_at=to_datetime(event['created_at'])
+                ))
+
+                settled.append({
+                    'event': event,
+                    'buyer': buyer,
+                    'seller': seller,
+                    'holding': holding
+                })
+
+            touched_users = set()
+            for (user_id, symbol), ticks in balance_ticks.items():
+                if ticks:
+                    users[user_id].balance += from_ticks(symbol, ticks)
+                    touched_users.add(user_id)
+            for user_id in touched_users:
+                users[user_id].save(update_fields=['balance'])
+            for key in touched_holdings:
+                holding = holdings[key]
+                if holding.quantity > 0:
+                    holding.save()
+                elif holding.pk:
+                    holding.delete()
+            Trade.objects.bulk_create(trades)
+            Order.objects.bulk_create(orders)
+            for symbol, seq in checkpoints.items():
+                SettlementCheckpoint.objects.update_or_create(symbol=symbol, defaults={'seq': seq})
+
+        return settled
@@ -0,0 +1,350 @@
+import asyncio
+import tempfile
+from decimal import Decimal
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from accounts.models import Holding
+from .history import user_trades
+from .journal import EngineJournal
+from .matching_engine import OrderMatchingEngine
+from .models import SettlementCheckpoint, Trade
+from .order_book import Order, OrderBook
+from .outbound import OutboundQueue
+from .sequencer import BookSequencer
+
+User = get_user_model()
+
+SYMBOL = 'RELIANCE'
+
+
+def fresh_engine() -> OrderMatchingEngine:
+    # A new engine built from the current settings, as after a restart.
+    OrderMatchingEngine._instance = None
+    return OrderMatchingEngine()
+
+
+def failed_submit(kind, payload):
+    future = asyncio.get_running_loop().create_future()
+    future.set_exception(OSError('journal append failed'))
+    return future
+
+
+@override_settings(TRADING_RESERVATION_LEDGER=True, TRADING_JOURNAL_DIR='')
+class EngineTestCase(TransactionTestCase):
+    # Engines are process-wide singletons; each test gets its own and the
+    # module's one is put back afterwards.
+    def setUp(self):
+        self.addCleanup(setattr, OrderMatchingEngine, '_instance', OrderMatchingEngine._instance)
+        self.buyer = User.objects.create(
+            username='buyer', email='buyer@example.com', name='Buyer', balance=Decimal('10000.00')
+        )
+        self.seller = User.objects.create(
+            username='seller', email='seller@example.com', name='Seller', balance=Decimal('0.00')
+        )
+        Holding.objects.create(user=self.seller, symbol=SYMBOL, quantity=100, price=Decimal('100.00'))
+
+    def order(self, user, order_type: str, quantity: int, price: int = 10000) -> dict:
+        # `price` is in ticks: 10000 is 100.00.
+        return {
+            'user_id': user.id, 'user_email': user.email, 'symbol': SYMBOL,
+            'order_type': order_type, 'price': price, 'quantity': quantity
+        }
+
+
+class ReservationReleaseTests(EngineTestCase):
+    def test_failed_submit_releases_reservation(self):
+        async def run():
+            engine = fresh_engine()
+            with mock.patch.object(engine, '_get_sequencer', return_value=mock.Mock(submit=failed_submit)):
+                with self.assertRaises(OSError):
+                    await engine.add_order(self.order(self.buyer, 'BUY', 10))
+                results = await engine.add_orders([
+                    self.order(self.buyer, 'BUY', 10),
+                    self.order(self.seller, 'SELL', 20)
+                ])
+            self.assertTrue(all(isinstance(result, OSError) for result in results))
+
+            buyer = await engine.ledger.account(self.buyer.id)
+            seller = await engine.ledger.account(self.seller.id)
+            self.assertEqual(buyer.cash, Decimal('10000.00'))
+            self.assertEqual(seller.positions[SYMBOL], 100)
+            self.assertEqual((buyer.inflight, seller.inflight), (0, 0))
+
+        async_to_sync(run)()
+
+    def test_settlement_dropping_reservation_releases_it(self):
+        async def run():
+            engine = fresh_engine()
+            seller = await engine.ledger.account(self.seller.id)
+            # The holding goes away behind the ledger's back, so settlement
+            # has nothing to take the sell order's reservation from.
+            await database_sync_to_async(Holding.objects.filter(user=self.seller).delete)()
+
+            sell = await engine.add_order(self.order(self.seller, 'SELL', 10, price=10100))
+            buy = await engine.add_order(self.order(self.buyer, 'BUY', 5))
+            await engine.settlement.wait_settled()
+
+            self.assertEqual(seller.positions[SYMBOL], 100)
+            self.assertEqual(seller.inflight, 0)
+            self.assertEqual(engine.settlement.failed_count, 1)
+            buyer = await engine.ledger.account(self.buyer.id)
+            self.assertEqual(buyer.inflight, 0)
+            return sell['order']['id'], buy['order']['id']
+
+        sell_id, buy_id = async_to_sync(run)()
+        # The rest of the batch still settles, and the checkpoint moves past
+        # the dropped command.
+        self.buyer.refresh_from_db()
+        self.assertEqual(self.buyer.balance, Decimal('9500.00'))
+        self.assertEqual(SettlementCheckpoint.objects.get(symbol=SYMBOL).seq, max(sell_id, buy_id))
+
+
+class CancelAmendTests(EngineTestCase):
+    def settle(self, scenario) -> Decimal:
+        # Runs `scenario(engine)` on a fresh engine, waits for settlement and
+        # returns the buyer's balance, checking the ledger agrees with it.
+        async def run():
+            engine = fresh_engine()
+            await scenario(engine)
+            await engine.settlement.wait_settled()
+            return (await engine.ledger.account(self.buyer.id)).cash
+
+        cash = async_to_sync(run)()
+        self.buyer.refresh_from_db()
+        self.assertEqual(cash, self.buyer.balance)
+        return self.buyer.balance
+
+    def test_cancel_releases_unfilled_remainder(self):
+        async def scenario(engine):
+            buy = await engine.add_order(self.order(self.buyer, 'BUY', 10))
+            await engine.add_order(self.order(self.seller, 'SELL', 4))
+            result = await engine.cancel_order(SYMBOL, buy['order']['id'], self.buyer.id)
+            self.assertTrue(result['success'])
+            self.assertEqual(result['order']['filled_quantity'], 4)
+
+        # 4 bought at 100.00; the other 6 are handed back.
+        self.assertEqual(self.settle(scenario), Decimal('9600.00'))
+
+    def test_amend_reducing_quantity_keeps_priority(self):
+        async def scenario(engine):
+            first = await engine.add_order(self.order(self.buyer, 'BUY', 10))
+            second = await engine.add_order(self.order(self.buyer, 'BUY', 5))
+            result = await engine.amend_order(SYMBOL, first['order']['id'], self.buyer.id, quantity=4)
+            self.assertTrue(result['success'])
+            level = engine.get_book(SYMBOL).bids.best_level()
+            self.assertEqual(list(level.orders), [first['order']['id'], second['order']['id']])
+            self.assertEqual(level.quantity, 9)
+
+        self.assertEqual(self.settle(scenario), Decimal('9100.00'))
+
+    def test_amend_changing_price_loses_priority(self):
+        async def scenario(engine):
+            first = await engine.add_order(self.order(self.buyer, 'BUY', 5, price=9900))
+            second = await engine.add_order(self.order(self.buyer, 'BUY', 5))
+            result = await engine.amend_order(SYMBOL, first['order']['id'], self.buyer.id, price=10000)
+            self.assertTrue(result['success'])
+            level = engine.get_book(SYMBOL).bids.best_level()
+            self.assertEqual(list(level.orders), [second['order']['id'], first['order']['id']])
+
+        self.assertEqual(self.settle(scenario), Decimal('9000.00'))
+
+    def test_cancel_by_another_user_is_rejected(self):
+        async def scenario(engine):
+            buy = await engine.add_order(self.order(self.buyer, 'BUY', 10))
+            result = await engine.cancel_order(SYMBOL, buy['order']['id'], self.seller.id)
+            self.assertEqual(result, {'success': False, 'error': 'Order not found'})
+            self.assertIn(buy['order']['id'], engine.get_book(SYMBOL))
+
+        self.assertEqual(self.settle(scenario), Decimal('9000.00'))
+
+
+class RecoveryTests(EngineTestCase):
+    def test_replay_after_snapshot_does_not_settle_twice(self):
+        journal_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(journal_dir.cleanup)
+
+        async def trade_then_restart():
+            engine = fresh_engine()
+            await engine.add_order(self.order(self.seller, 'SELL', 10))
+            await engine.add_order(self.order(self.buyer, 'BUY', 10))
+            # The third command is snapshotted; the two after it are only
+            # in the journal.
+            await engine.add_order(self.order(self.seller, 'SELL', 5))
+            await engine.add_order(self.order(self.buyer, 'BUY', 5))
+            await engine.add_order(self.order(self.seller, 'SELL', 1, price=10100))
+            await engine.settlement.wait_settled()
+            await asyncio.gather(*engine._snapshot_tasks.values())
+            self.assertEqual(engine._snapshot_seqs[SYMBOL], 3)
+            engine.journal.close(SYMBOL)
+
+            restarted = fresh_engine()
+            await restarted.start()
+            await restarted.settlement.wait_settled()
+            self.assertEqual(restarted.sequencers[SYMBOL].last_seq, 5)
+            self.assertEqual(len(restarted.get_book(SYMBOL).index), 1)
+            # The fill replayed from the journal is back in the open candles.
+            self.assertEqual(restarted.candles.history_of(SYMBOL)['1h'][-1]['volume'], 5)
+
+        with override_settings(TRADING_JOURNAL_DIR=journal_dir.name, TRADING_SNAPSHOT_INTERVAL=3):
+            async_to_sync(trade_then_restart)()
+
+        self.buyer.refresh_from_db()
+        self.seller.refresh_from_db()
+        self.assertEqual(Trade.objects.count(), 2)
+        self.assertEqual(self.buyer.balance, Decimal('8500.00'))
+        self.assertEqual(self.seller.balance, Decimal('1500.00'))
+        self.assertEqual(Holding.objects.get(user=self.buyer).quantity, 15)
+        self.assertEqual(Holding.objects.get(user=self.seller).quantity, 84)
+
+
+class JournalRollbackTests(SimpleTestCase):
+    def test_batch_that_fails_to_journal_is_not_replayed(self):
+        journal_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(journal_dir.cleanup)
+        journal = EngineJournal(journal_dir.name)
+        append = journal.append
+
+        def append_or_fail(symbol, seq, kind, payload):
+            if seq == 3:
+                raise OSError('disk full')
+            append(symbol, seq, kind, payload)
+
+        applied = []
+
+        async def on_batch(symbol, events):
+            pass
+
+        async def run():
+            sequencer = BookSequencer(
+                SYMBOL, lambda kind, payload, seq, events: applied.append(seq), on_batch, journal=journal
+            )
+            await sequencer.submit('add', {})
+            # Both land in one batch; the second append fails after the
+            # first was buffered.
+            failed = [sequencer.submit('add', {}), sequencer.submit('add', {})]
+            results = await asyncio.gather(*failed, return_exceptions=True)
+            self.assertTrue(all(isinstance(result, OSError) for result in results))
+            await sequencer.submit('add', {})
+
+        with mock.patch.object(journal, 'append', append_or_fail):
+            asyncio.run(run())
+        journal.close(SYMBOL)
+
+        self.assertEqual(applied, [1, 4])
+        self.assertEqual([seq for seq, _, _ in journal.load(SYMBOL)[2]], [1, 4])
+
+
+class HistoryTests(TestCase):
+    def test_self_trades_page_both_sides(self):
+        user = User.objects.create(username='trader', email='trader@example.com', name='Trader')
+        executed_at = timezone.now()
+        for trade_id in range(1, 4):
+            Trade.objects.create(
+                symbol=SYMBOL, trade_id=trade_id, price=Decimal('100.00'), quantity=1,
+                total_amount=Decimal('100.00'), buyer=user, seller=user,
+                buy_order_id=2 * trade_id, sell_order_id=2 * trade_id - 1, executed_at=executed_at
+            )
+
+        rows, cursor = [], None
+        while True:
+            page = user_trades(user.id, 1, cursor)
+            rows.extend((row['trade_id'], row['side']) for row in page['results'])
+            cursor = page['next_cursor']
+            if cursor is None:
+                break
+
+        self.assertEqual(rows, [
+            (3, 'SELL'), (3, 'BUY'), (2, 'SELL'), (2, 'BUY'), (1, 'SELL'), (1, 'BUY')
+        ])
+
+
+class OutboundQueueTests(SimpleTestCase):
+    def test_stale_keyed_frame_drops_connection(self):
+        async def run():
+            async def send(frame):
+                pass
+
+            dropped = []
+            outbound = OutboundQueue(send, lambda: dropped.append(True), max_pending=10, max_lag_seconds=5)
+            with mock.patch('trading.outbound.time.monotonic', side_effect=[100.0, 106.0]):
+                outbound.put('delta 1', SYMBOL)
+                # Only ever replaces the waiting frame, which is now too old.
+                outbound.put('delta 2', SYMBOL)
+            return dropped, outbound.closed
+
+        self.assertEqual(asyncio.run(run()), ([True], True))
+
+
+def book_order(order_id: int, order_type: str, price: int, quantity: int = 10) -> Order:
+    return Order(order_id, 1, 'trader@example.com', SYMBOL, order_type, price, quantity, created_at=order_id)
+
+
+class OrderBookTests(SimpleTestCase):
+    def test_orders_at_a_price_fill_first_in_first_out(self):
+        book = OrderBook(SYMBOL)
+        for order_id in (1, 2, 3, 4):
+            book.add(book_order(order_id, 'BUY', 100))
+        book.remove(2)
+
+        self.assertEqual([book.bids.pop_best_order().id for _ in range(3)], [1, 3, 4])
+        self.assertFalse(book.bids)
+
+    def test_best_level_moves_on_when_a_level_empties(self):
+        book = OrderBook(SYMBOL)
+        book.add(book_order(1, 'BUY', 100))
+        book.add(book_order(2, 'BUY', 101))
+        book.add(book_order(3, 'SELL', 103))
+        book.add(book_order(4, 'SELL', 102))
+
+        book.bids.pop_best_order()
+        book.remove(4)
+        self.assertEqual(book.bids.best_level().price, 100)
+        self.assertEqual(book.asks.best_level().price, 103)
+
+        book.remove(1)
+        self.assertIsNone(book.bids.best_level())
+        self.assertIsNone(book.bids.best_order())
+
+    def test_depth_lists_best_levels_first(self):
+        book = OrderBook(SYMBOL)
+        order_id = 0
+        for order_type, price in (('BUY', 99), ('BUY', 101), ('BUY', 100), ('BUY', 101),
+                                  ('SELL', 104), ('SELL', 102), ('SELL', 103)):
+            order_id += 1
+            book.add(book_order(order_id, order_type, price))
+
+        self.assertEqual(book.bids.depth(2), [
+            {'price': 101, 'quantity': 20, 'orders': 2},
+            {'price': 100, 'quantity': 10, 'orders': 1},
+        ])
+        self.assertEqual([level['price'] for level in book.asks.depth(5)], [102, 103, 104])
+
+
+class OrderBookDeltaTests(SimpleTestCase):
+    def test_consecutive_deltas_chain(self):
+        book = OrderBook(SYMBOL)
+        book.add(book_order(1, 'BUY', 100))
+        first = book.take_delta(5)
+        self.assertIsNone(book.take_delta(5))
+        book.add(book_order(2, 'SELL', 101))
+        second = book.take_delta(5)
+
+        self.assertEqual(first[0], 0)
+        self.assertEqual(second[0], first[1])
+        self.assertGreater(second[1], first[1])
+        self.assertEqual(second[2], [{'side': 'ask', 'price': 101, 'quantity': 10, 'orders': 1}])
+
+    def test_cleared_level_is_sent_as_zero_quantity(self):
+        book = OrderBook(SYMBOL)
+        book.add(book_order(1, 'BUY', 100))
+        book.add(book_order(2, 'BUY', 99))
+        book.take_delta(5)
+        book.remove(1)
+
+        self.assertEqual(book.take_delta(5)[2], [{'side': 'bid', 'price': 100, 'quantity': 0, 'orders': 0}])
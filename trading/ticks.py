@@ -0,0 +1,29 @@
+from decimal import Decimal
+from functools import lru_cache
+
+from django.conf import settings
+
+
+@lru_cache(maxsize=None)
+def tick_size(symbol: str) -> Decimal:
+    return Decimal(str(settings.TRADING_TICK_SIZES.get(symbol, settings.TRADING_TICK_SIZE)))
+
+
+def to_ticks(symbol: str, price) -> int:
+    # Inside the engine a price is a whole number of ticks and an amount is
+    # ticks * quantity; Decimal only appears where prices enter or leave.
+    try:
+        ticks, remainder = divmod(Decimal(str(price)), tick_size(symbol))
+    except ArithmeticError:
+        raise ValueError(f'Invalid price: {price}')
+    if remainder:
+        raise ValueError(f'Price must be a multiple of the tick size {tick_size(symbol)}')
+    return int(ticks)
+
+
+def from_ticks(symbol: str, ticks: int) -> Decimal:
+    return tick_size(symbol) * ticks
+
+
+def ticks_to_float(symbol: str, ticks: int) -> float:
+    return float(tick_size(symbol) * ticks)
\ No newline at end of file
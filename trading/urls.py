@@ -1,6 +1,14 @@
-from django.urls import re_path
-from . import consumers
+from django.urls import path, re_path
+from . import consumers, views
 
 websocket_urlpatterns = [
     re_path(r'trading/$', consumers.TradingConsumer.as_asgi()),
+]
+
+urlpatterns = [
+    path('trading/status/', views.engine_status, name='engine_status'),
+    path('trading/orders/batch/', views.place_orders, name='place_orders'),
+    path('trading/orders/history/', views.my_orders, name='my_orders'),
+    path('trading/trades/', views.my_trades, name='my_trades'),
+    path('trading/trades/<str:symbol>/', views.trade_tape, name='trade_tape'),
 ]
\ No newline at end of file
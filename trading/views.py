@@ -0,0 +1,79 @@
+from rest_framework import status
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from asgiref.sync import async_to_sync
+from .gateway import gateway
+from .history import page_limit, symbol_trades, user_orders, user_trades
+from .matching_engine import normalize_symbol
+from .orders import place_order_batch
+
+def engine_unavailable():
+    # An embedded engine lives in the ASGI server, whose sync views reach it
+    # through async_to_sync on the server's own loop. Any other process
+    # serving the REST API (runserver/WSGI) would start an engine of its own:
+    # on a fresh event loop per request, and over the same journal as the
+    # real one.
+    if not gateway.available:
+        return Response({
+            'error': 'The matching engine runs inside the ASGI server; send this request there '
+                     'or run with TRADING_ENGINE_MODE=remote'
+        }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    return None
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def engine_status(request):
+    unavailable = engine_unavailable()
+    if unavailable is not None:
+        return unavailable
+    return Response(async_to_sync(gateway.get_stats)(), status=status.HTTP_200_OK)
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def place_orders(request):
+    unavailable = engine_unavailable()
+    if unavailable is not None:
+        return unavailable
+    orders = request.data.get('orders') if isinstance(request.data, dict) else None
+    try:
+        results = async_to_sync(place_order_batch)(request.user, orders)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    accepted = sum(1 for result in results if result['success'])
+    return Response({
+        'accepted': accepted,
+        'rejected': len(results) - accepted,
+        'results': results
+    }, status=status.HTTP_200_OK)
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def my_trades(request):
+    try:
+        page = user_trades(request.user.id, page_limit(request.query_params.get('limit')),
+                           request.query_params.get('before'))
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return Response(page, status=status.HTTP_200_OK)
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def my_orders(request):
+    try:
+        page = user_orders(request.user.id, page_limit(request.query_params.get('limit')),
+                           request.query_params.get('before'))
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return Response(page, status=status.HTTP_200_OK)
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def trade_tape(request, symbol):
+    try:
+        page = symbol_trades(normalize_symbol(symbol), page_limit(request.query_params.get('limit')),
+                             request.query_params.get('before'))
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return Response(page, status=status.HTTP_200_OK)
\ No newline at end of file